@@ -0,0 +1,170 @@
+"""
+Admission control in front of the model endpoint.
+
+At most ADMISSION_MAX_INFLIGHT generations per worker talk to the model at
+once. Further requests wait in a weighted fair queue: each doctor's requests
+get virtual finish tags spaced 1/weight apart, and the lowest tag is admitted
+next, so one doctor firing many requests only delays their own. While
+waiting, the stream reports its queue position; a full queue is refused with
+429 before the stream starts, and a wait past ADMISSION_QUEUE_TIMEOUT ends the
+stream with an error event.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import HTTPException
+
+import metrics
+import sse
+
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "64"))
+ADMISSION_QUEUE_MAX = int(os.getenv("ADMISSION_QUEUE_MAX", "256"))
+ADMISSION_MAX_QUEUED_PER_DOCTOR = int(os.getenv("ADMISSION_MAX_QUEUED_PER_DOCTOR", "8"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# How often a queued stream re-checks (and re-reports) its position
+ADMISSION_POSITION_INTERVAL = float(os.getenv("ADMISSION_POSITION_INTERVAL", "1"))
+# Per-doctor weights as "doctor_id:weight,..."; everyone else weighs 1
+ADMISSION_WEIGHTS: Dict[str, float] = {
+    doctor_id.strip(): float(weight)
+    for doctor_id, weight in (
+        item.split(":", 1) for item in os.getenv("ADMISSION_WEIGHTS", "").split(",") if ":" in item
+    )
+}
+
+class Ticket:
+    def __init__(self, doctor_id: str, tag: float = 0.0, seq: int = 0):
+        self.doctor_id = doctor_id
+        self.tag = tag
+        self.seq = seq
+        self.granted = False
+        self.cancelled = False
+        self.released = False
+        self.enqueued_at = time.monotonic()
+        self.future: Optional[asyncio.Future] = None
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+class AdmissionController:
+    """Per-worker; all methods run on the event loop, so no locking is needed"""
+
+    def __init__(self, max_inflight: int, queue_max: int, max_queued_per_doctor: int):
+        self.max_inflight = max_inflight
+        self.queue_max = queue_max
+        self.max_queued_per_doctor = max_queued_per_doctor
+        self.inflight = 0
+        self.queue: List[Ticket] = []  # heap of waiting tickets, cancelled ones removed lazily
+        self.waiting = 0
+        self.queued_by_doctor: Dict[str, int] = {}
+        self.last_finish: Dict[str, float] = {}
+        self.virtual_time = 0.0
+        self._seq = itertools.count()
+
+    def _gauges(self):
+        metrics.set_gauge("admission_inflight", self.inflight)
+        metrics.set_gauge("admission_queue_depth", self.waiting)
+
+    def acquire(self, doctor_id: str) -> Ticket:
+        """Admit now, or queue; raises 429 when the queue (or the doctor's share of it) is full"""
+        if self.inflight < self.max_inflight and self.waiting == 0:
+            ticket = Ticket(doctor_id)
+            ticket.granted = True
+            self.inflight += 1
+            metrics.inc("admission_admitted")
+            self._gauges()
+            return ticket
+        if self.waiting >= self.queue_max or self.queued_by_doctor.get(doctor_id, 0) >= self.max_queued_per_doctor:
+            metrics.inc("admission_rejected")
+            raise HTTPException(429, "Too many generations in progress, please retry shortly",
+                                headers={"Retry-After": "5"})
+        weight = ADMISSION_WEIGHTS.get(doctor_id, 1.0)
+        tag = max(self.virtual_time, self.last_finish.get(doctor_id, 0.0)) + 1.0 / weight
+        self.last_finish[doctor_id] = tag
+        ticket = Ticket(doctor_id, tag, next(self._seq))
+        ticket.future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, ticket)
+        self.waiting += 1
+        self.queued_by_doctor[doctor_id] = self.queued_by_doctor.get(doctor_id, 0) + 1
+        metrics.inc("admission_queued")
+        self._gauges()
+        return ticket
+
+    def _dequeued(self, ticket: Ticket):
+        self.waiting -= 1
+        left = self.queued_by_doctor[ticket.doctor_id] - 1
+        if left:
+            self.queued_by_doctor[ticket.doctor_id] = left
+        else:
+            del self.queued_by_doctor[ticket.doctor_id]
+        metrics.observe("admission_wait_ms", (time.monotonic() - ticket.enqueued_at) * 1000)
+
+    def _grant_next(self):
+        while self.queue and self.inflight < self.max_inflight:
+            ticket = heapq.heappop(self.queue)
+            if ticket.cancelled:
+                continue
+            self._dequeued(ticket)
+            self.virtual_time = ticket.tag
+            ticket.granted = True
+            self.inflight += 1
+            metrics.inc("admission_admitted")
+            ticket.future.set_result(True)
+        if not self.queue and not self.inflight:
+            # Idle: drop finish tags so returning doctors start level with everyone
+            self.last_finish.clear()
+            self.virtual_time = 0.0
+        self._gauges()
+
+    def release(self, ticket: Ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.granted:
+            self.inflight -= 1
+        elif not ticket.cancelled:
+            ticket.cancelled = True
+            self._dequeued(ticket)
+        self._grant_next()
+
+    def position(self, ticket: Ticket) -> int:
+        return 1 + sum(1 for t in self.queue if not t.cancelled and t < ticket)
+
+    async def wait(self, ticket: Ticket, timeout: float = ADMISSION_QUEUE_TIMEOUT) -> AsyncIterator[int]:
+        """Yield the ticket's queue position whenever it changes until admitted; TimeoutError past `timeout`"""
+        deadline = ticket.enqueued_at + timeout
+        last = None
+        while not ticket.granted:
+            position = self.position(ticket)
+            if position != last:
+                last = position
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                metrics.inc("admission_timeouts")
+                raise TimeoutError
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.future), min(remaining, ADMISSION_POSITION_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+
+controller = AdmissionController(ADMISSION_MAX_INFLIGHT, ADMISSION_QUEUE_MAX, ADMISSION_MAX_QUEUED_PER_DOCTOR)
+
+async def admitted(ticket: Ticket, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Wrap an SSE stream: wait for admission (reporting queue position), then relay it"""
+    try:
+        if not ticket.granted:
+            try:
+                async for position in controller.wait(ticket):
+                    yield sse.event("queued", {"position": position})
+            except TimeoutError:
+                yield sse.event("error", {"error": "Timed out waiting for a free model slot"})
+                return
+        async for chunk in stream:
+            yield chunk
+    finally:
+        controller.release(ticket)
+        await stream.aclose()
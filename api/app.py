@@ -1,25 +1,41 @@
-import os, io, base64, requests, aiofiles
+import os, io, json, asyncio, contextlib
 from typing import List, Optional
 from datetime import datetime
-from fastapi import FastAPI, Depends, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, Depends, UploadFile, File, Form, HTTPException, Request, Response, Query
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from sqlalchemy import func, select, and_
 from sqlalchemy.orm import Session
-from models import init_db, Doctor, Patient, Chat, Message
-from models import SessionLocal
-from db import get_db, get_doctor_id
-from auth import make_hash, verify_hash, make_token
-from google.auth.transport import requests as google_requests
-from google.oauth2 import id_token
-from rag import retrieve_context, save_conversation_context
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import init_db, async_engine, Doctor, Patient, Chat, Message
+from db import get_db, get_async_db, get_doctor_id, get_doctor_profile, invalidate_doctor
+from auth import make_token, hash_password, check_password, start_hash_pool, shutdown_hash_pool
+from google_certs import verify_google_id_token
+from rag import retrieve_context
+import upstream
+import summaries
+import response_cache
+import admission
+import sse
+import generations
+import writebehind
+from routing import EndpointRouter
+from media import image_data_url, save_upload, collect_orphan_blobs, UploadLimitMiddleware
+import metrics
+from prompt import build_prompt, PROMPT_HISTORY_MESSAGES
+from pagination import paginate, apply_keyset, encode_cursor, set_next_cursor, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER
 from dotenv import load_dotenv
 
 load_dotenv()  # Load environment variables from .env file
 
-MODEL_ENDPOINT = os.getenv("MODEL_ENDPOINT")
+# Comma-separated replicas of the same model; generations are balanced across them
+MODEL_ENDPOINTS = [url.strip() for url in os.getenv("MODEL_ENDPOINTS", "").split(",") if url.strip()]
+MODEL_ENDPOINT = os.getenv("MODEL_ENDPOINT") or (MODEL_ENDPOINTS[0] if MODEL_ENDPOINTS else None)
 if not MODEL_ENDPOINT:
-    raise ValueError("MODEL_ENDPOINT environment variable is required. Please set it in your .env file.")
+    raise ValueError("MODEL_ENDPOINT (or MODEL_ENDPOINTS) environment variable is required. Please set it in your .env file.")
+model_router = EndpointRouter(MODEL_ENDPOINTS or [MODEL_ENDPOINT])
 PORT = int(os.getenv("PORT", "8000"))
 os.makedirs("storage", exist_ok=True)
 
@@ -59,6 +75,10 @@ allowed_origins = list(set([origin.strip() for origin in allowed_origins if orig
 
 print(f"🌐 CORS allowed origins: {allowed_origins}")
 
+# Reject oversized uploads before the multipart body is spooled. Added first so
+# CORS (added after, hence outermost) still decorates the 413 response.
+app.add_middleware(UploadLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
@@ -71,15 +91,48 @@ app.add_middleware(
         "Accept", 
         "Origin",
         "X-Requested-With",
+        "Last-Event-ID",
+        "Idempotency-Key",
         "Access-Control-Request-Method",
         "Access-Control-Request-Headers",
     ],
-    expose_headers=["*"],
+    # Browsers ignore the "*" wildcard on credentialed requests, so name the header clients read
+    expose_headers=["*", NEXT_CURSOR_HEADER, "X-Response-Cache", "X-Generation-Id"],
     max_age=3600,  # Cache preflight requests for 1 hour
 )
 
 init_db()
 
+@app.on_event("startup")
+def remove_orphan_blobs():
+    removed = collect_orphan_blobs()
+    if removed:
+        print(f"Removed {removed} unreferenced upload blobs")
+
+@app.on_event("startup")
+def start_password_hashing():
+    start_hash_pool()
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    await upstream.close_client()
+
+@app.on_event("shutdown")
+def stop_password_hashing():
+    shutdown_hash_pool()
+
+@app.on_event("startup")
+def start_write_behind():
+    writebehind.start()
+
+@app.on_event("shutdown")
+def drain_write_behind():
+    writebehind.stop()
+
+@app.on_event("shutdown")
+async def close_async_engine():
+    await async_engine.dispose()
+
 # ---------- Auth ----------
 class RegisterBody(BaseModel):
     email: str
@@ -87,11 +140,14 @@ class RegisterBody(BaseModel):
     password: str
 
 @app.post("/auth/register")
-def register(body: RegisterBody, db: Session = Depends(get_db)):
-    if db.query(Doctor).filter_by(email=body.email).first():
+async def register(body: RegisterBody, db: AsyncSession = Depends(get_async_db)):
+    # bcrypt runs in the hashing process pool, the DB work on the event loop
+    if await db.scalar(select(Doctor.id).filter_by(email=body.email)):
         raise HTTPException(409, "Email exists")
-    doc = Doctor(email=body.email, name=body.name or body.email.split("@")[0], password_hash=make_hash(body.password))
-    db.add(doc); db.commit()
+    doc = Doctor(email=body.email, name=body.name or body.email.split("@")[0],
+                 password_hash=await hash_password(body.password))
+    db.add(doc)
+    await db.commit()
     token = make_token(doc.id, doc.email)
     return {"token": token, "doctor_id": doc.id, "name": doc.name}
 
@@ -100,34 +156,33 @@ class LoginBody(BaseModel):
     password: str
 
 @app.post("/auth/login")
-def login(body: LoginBody, db: Session = Depends(get_db)):
-    doc = db.query(Doctor).filter_by(email=body.email).first()
-    if not doc or not verify_hash(body.password, doc.password_hash):
+async def login(body: LoginBody, db: AsyncSession = Depends(get_async_db)):
+    doc = await db.scalar(select(Doctor).filter_by(email=body.email))
+    ok, new_hash = await check_password(body.password, doc.password_hash if doc else None)
+    if not ok:
         raise HTTPException(401, "Invalid credentials")
+    if new_hash:
+        # BCRYPT_ROUNDS changed since this hash was made
+        doc.password_hash = new_hash
+        await db.commit()
+        metrics.inc("auth_hash_upgrades")
     return {"token": make_token(doc.id, doc.email), "doctor_id": doc.id, "name": doc.name}
 
 @app.post("/auth/refresh")
-def refresh_token(doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
+async def refresh_token(doctor_id: str = Depends(get_doctor_id), db: AsyncSession = Depends(get_async_db)):
     """Refresh JWT token for continued authentication"""
-    doc = db.query(Doctor).filter_by(id=doctor_id).first()
+    doc = await get_doctor_profile(db, doctor_id)
     if not doc:
         raise HTTPException(401, "Invalid token")
-    return {"token": make_token(doc.id, doc.email), "doctor_id": doc.id, "name": doc.name}
+    return {"token": make_token(doc["doctor_id"], doc["email"]), "doctor_id": doc["doctor_id"], "name": doc["name"]}
 
 @app.get("/auth/me")
-def get_current_user(doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
+async def get_current_user(doctor_id: str = Depends(get_doctor_id), db: AsyncSession = Depends(get_async_db)):
     """Get current user info from token"""
-    doc = db.query(Doctor).filter_by(id=doctor_id).first()
+    doc = await get_doctor_profile(db, doctor_id)
     if not doc:
         raise HTTPException(401, "Invalid token")
-    return {
-        "doctor_id": doc.id, 
-        "name": doc.name, 
-        "email": doc.email,
-        "avatar_url": doc.avatar_url,
-        "specialty": doc.specialty,
-        "phone": doc.phone
-    }
+    return doc
 
 class GoogleAuthBody(BaseModel):
     token: str
@@ -137,11 +192,7 @@ def google_auth(body: GoogleAuthBody, db: Session = Depends(get_db)):
     """Authenticate with Google OAuth token"""
     try:
         # Verify the Google token
-        idinfo = id_token.verify_oauth2_token(
-            body.token, 
-            google_requests.Request(), 
-            os.getenv("GOOGLE_CLIENT_ID")
-        )
+        idinfo = verify_google_id_token(body.token, os.getenv("GOOGLE_CLIENT_ID"))
         
         # Extract user info
         google_id = idinfo['sub']
@@ -176,6 +227,7 @@ def google_auth(body: GoogleAuthBody, db: Session = Depends(get_db)):
         # Update last login
         doc.last_login = datetime.utcnow()
         db.commit()
+        invalidate_doctor(doc.id)
         
         # Return JWT token
         token = make_token(doc.id, doc.email)
@@ -199,31 +251,75 @@ class PatientBody(BaseModel):
     notes: Optional[str] = None
 
 @app.post("/patients")
-def create_patient(body: PatientBody, doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
+async def create_patient(body: PatientBody, doctor_id: str = Depends(get_doctor_id), db: AsyncSession = Depends(get_async_db)):
     p = Patient(doctor_id=doctor_id, name=body.name, mrn=body.mrn, notes=body.notes)
-    db.add(p); db.commit()
+    db.add(p); await db.commit()
     return {"id": p.id, "name": p.name, "mrn": p.mrn, "notes": p.notes}
 
 @app.get("/patients")
-def list_patients(doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
-    rows = db.query(Patient).filter_by(doctor_id=doctor_id).order_by(Patient.created_at.desc()).all()
+async def list_patients(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    doctor_id: str = Depends(get_doctor_id),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Newest first. With `limit`, returns one page and the next cursor in X-Next-Cursor."""
+    query = select(Patient).filter_by(doctor_id=doctor_id)
+    if limit or cursor:
+        rows, next_cursor = await paginate(db, query, Patient, limit or MAX_PAGE_SIZE, cursor)
+        set_next_cursor(response, next_cursor)
+    else:
+        rows = (await db.scalars(query.order_by(Patient.created_at.desc()))).all()
     return [{"id": r.id, "name": r.name, "mrn": r.mrn, "notes": r.notes} for r in rows]
 
 @app.get("/patients/{patient_id}")
-def get_patient_profile(patient_id: str, doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
+async def get_patient_profile(
+    patient_id: str,
+    files_limit: int = Query(100, ge=1, le=500),
+    doctor_id: str = Depends(get_doctor_id),
+    db: AsyncSession = Depends(get_async_db)
+):
     """Get patient profile with conversations and uploaded files"""
-    patient = db.query(Patient).filter_by(id=patient_id, doctor_id=doctor_id).first()
+    patient = await db.scalar(select(Patient).filter_by(id=patient_id, doctor_id=doctor_id))
     if not patient:
         raise HTTPException(404, "Patient not found")
     
-    # Get patient chats
-    chats = db.query(Chat).filter_by(patient_id=patient_id, doctor_id=doctor_id).order_by(Chat.created_at.desc()).all()
+    # Get patient chats with per-chat message counts and last activity. Correlated
+    # subqueries resolve from the (chat_id, created_at) index, one probe per chat.
+    message_count = (
+        select(func.count(Message.id)).where(Message.chat_id == Chat.id)
+        .correlate(Chat).scalar_subquery()
+    )
+    last_activity = (
+        select(func.max(Message.created_at)).where(Message.chat_id == Chat.id)
+        .correlate(Chat).scalar_subquery()
+    )
+    chats = (await db.execute(
+        select(Chat.id, Chat.title, Chat.created_at, message_count.label("message_count"),
+               last_activity.label("last_activity"))
+        .where(Chat.patient_id == patient_id, Chat.doctor_id == doctor_id)
+        .order_by(Chat.created_at.desc())
+    )).all()
     
-    # Get patient messages with files
-    messages = db.query(Message).filter_by(patient_id=patient_id, doctor_id=doctor_id).order_by(Message.created_at.desc()).all()
+    # Latest 10 messages; text is cut in SQL so long replies are never loaded whole
+    recent_messages = (await db.execute(
+        select(Message.id, Message.role, func.substr(Message.text, 1, 201).label("text"),
+               Message.chat_id, Message.created_at)
+        .where(Message.patient_id == patient_id, Message.doctor_id == doctor_id)
+        .order_by(Message.created_at.desc())
+        .limit(10)
+    )).all()
     
-    # Get files uploaded for this patient
-    files = [m for m in messages if m.media_url]
+    # Get files uploaded for this patient, newest first (partial index on media_url)
+    files = (await db.execute(
+        select(Message.id, Message.media_url, Message.media_type, Message.file_name,
+               Message.chat_id, Message.created_at)
+        .where(Message.patient_id == patient_id, Message.doctor_id == doctor_id,
+               Message.media_url.isnot(None))
+        .order_by(Message.created_at.desc())
+        .limit(files_limit)
+    )).all()
     
     return {
         "patient": {
@@ -236,15 +332,17 @@ def get_patient_profile(patient_id: str, doctor_id: str = Depends(get_doctor_id)
         "chats": [{
             "id": c.id,
             "title": c.title,
-            "created_at": c.created_at.isoformat()
+            "created_at": c.created_at.isoformat(),
+            "message_count": c.message_count,
+            "last_activity": c.last_activity.isoformat() if c.last_activity else None
         } for c in chats],
         "recent_messages": [{
             "id": m.id,
             "role": m.role,
-            "text": m.text[:200] + "..." if len(m.text) > 200 else m.text,
+            "text": m.text[:200] + "..." if m.text and len(m.text) > 200 else m.text,
             "chat_id": m.chat_id,
             "created_at": m.created_at.isoformat()
-        } for m in messages[:10]],
+        } for m in recent_messages],
         "files": [{
             "id": f.id,
             "media_url": f.media_url,
@@ -258,7 +356,7 @@ def get_patient_profile(patient_id: str, doctor_id: str = Depends(get_doctor_id)
 # ---------- Chats / Messages ----------
 # Put specific routes before generic ones
 @app.post("/chats/general")
-def create_general_chat(title: str = "General Chat", doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
+async def create_general_chat(title: str = "General Chat", doctor_id: str = Depends(get_doctor_id), db: AsyncSession = Depends(get_async_db)):
     """Create a general chat not associated with any patient"""
     c = Chat(
         doctor_id=doctor_id, 
@@ -267,7 +365,7 @@ def create_general_chat(title: str = "General Chat", doctor_id: str = Depends(ge
         title=title,
         is_general="true"
     )
-    db.add(c); db.commit()
+    db.add(c); await db.commit()
     return {
         "id": c.id, 
         "title": c.title, 
@@ -277,17 +375,17 @@ def create_general_chat(title: str = "General Chat", doctor_id: str = Depends(ge
     }
 
 @app.post("/chats")
-def create_chat(
+async def create_chat(
     patient_id: Optional[str] = None, 
     title: str = "Consult", 
     is_general: bool = False,
     doctor_id: str = Depends(get_doctor_id), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     patient_name = None
     if patient_id and not is_general:
         # Get patient name for easy access
-        patient = db.query(Patient).filter_by(id=patient_id).first()
+        patient = await db.scalar(select(Patient).filter_by(id=patient_id))
         if patient:
             patient_name = patient.name
         else:
@@ -300,7 +398,7 @@ def create_chat(
         title=title,
         is_general="true" if is_general else "false"
     )
-    db.add(c); db.commit()
+    db.add(c); await db.commit()
     return {
         "id": c.id, 
         "title": c.title, 
@@ -309,20 +407,125 @@ def create_chat(
         "is_general": c.is_general == "true"
     }
 
+# Characters of the last message shown in chat list previews
+CHAT_PREVIEW_CHARS = 120
+
+async def chat_overview(db: AsyncSession, query, limit: Optional[int], cursor: Optional[str], sort: str):
+    """
+    Chats from `query` with their last message preview, last activity, message
+    count and attachment count, in one statement. The page of chats is selected
+    first; a window function over that page's messages then picks each chat's
+    latest message and counts, so the cost is bounded by the page, not by the
+    doctor's whole history. Returns (rows, next_cursor).
+    """
+    if sort == "activity":
+        last_message_at = (
+            select(func.max(Message.created_at))
+            .where(Message.chat_id == Chat.id)
+            .correlate(Chat)
+            .scalar_subquery()
+        )
+        sort_column = func.coalesce(last_message_at, Chat.created_at)
+    else:
+        sort_column = Chat.created_at
+    page = apply_keyset(query.add_columns(sort_column.label("sort_key")), sort_column, Chat.id, cursor)
+    if limit:
+        # One extra row tells us whether another page exists
+        page = page.limit(limit + 1)
+    page = page.subquery()
+
+    ranked = (
+        select(
+            Message.chat_id,
+            func.substr(Message.text, 1, CHAT_PREVIEW_CHARS + 1).label("preview"),
+            Message.role.label("last_role"),
+            Message.created_at.label("last_message_at"),
+            func.row_number().over(
+                partition_by=Message.chat_id,
+                order_by=(Message.created_at.desc(), Message.id.desc()),
+            ).label("rn"),
+            func.count(Message.id).over(partition_by=Message.chat_id).label("message_count"),
+            func.count(Message.media_url).over(partition_by=Message.chat_id).label("attachment_count"),
+        )
+        .where(Message.chat_id.in_(select(page.c.id)))
+        .subquery()
+    )
+    rows = (await db.execute(
+        select(page, ranked.c.preview, ranked.c.last_role, ranked.c.last_message_at,
+               ranked.c.message_count, ranked.c.attachment_count)
+        .outerjoin(ranked, and_(ranked.c.chat_id == page.c.id, ranked.c.rn == 1))
+        .order_by(page.c.sort_key.desc(), page.c.id.desc())
+    )).all()
+
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].sort_key, rows[-1].id)
+    return rows, next_cursor
+
+def chat_overview_fields(row) -> dict:
+    preview = row.preview
+    if preview and len(preview) > CHAT_PREVIEW_CHARS:
+        preview = preview[:CHAT_PREVIEW_CHARS] + "..."
+    last_activity = row.last_message_at or row.created_at
+    return {
+        "last_message": preview,
+        "last_message_role": row.last_role,
+        "last_activity": last_activity.isoformat(),
+        "message_count": row.message_count or 0,
+        "attachment_count": row.attachment_count or 0,
+    }
+
+async def list_chat_rows(db: AsyncSession, query, response: Response, limit: Optional[int], cursor: Optional[str],
+                   summary: bool, sort: str):
+    """Rows for the chat list endpoints; overview rows when a summary or activity order is asked for"""
+    if summary or sort == "activity":
+        rows, next_cursor = await chat_overview(db, query, limit, cursor, sort)
+        set_next_cursor(response, next_cursor)
+        return rows, True
+    if limit or cursor:
+        cs, next_cursor = await paginate(db, query, Chat, limit or MAX_PAGE_SIZE, cursor)
+        set_next_cursor(response, next_cursor)
+        return cs, False
+    return (await db.scalars(query.order_by(Chat.created_at.desc()))).all(), False
+
 @app.get("/chats/general")
-def list_general_chats(doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
-    """Get all general chats (not patient-specific)"""
-    cs = db.query(Chat).filter_by(doctor_id=doctor_id, is_general="true").order_by(Chat.created_at.desc()).all()
+async def list_general_chats(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    summary: bool = False,
+    sort: str = Query("created", pattern="^(created|activity)$"),
+    doctor_id: str = Depends(get_doctor_id),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Get all general chats (not patient-specific), newest first; paginated when
+    `limit` is given. `summary=true` adds the last message preview and counts,
+    and `sort=activity` orders by the latest message instead of creation time.
+    """
+    query = select(Chat).filter_by(doctor_id=doctor_id, is_general="true")
+    cs, overview = await list_chat_rows(db, query, response, limit, cursor, summary, sort)
     return [{
         "id": c.id, 
         "title": c.title, 
         "is_general": True,
-        "created_at": c.created_at.isoformat()
+        "created_at": c.created_at.isoformat(),
+        **(chat_overview_fields(c) if overview else {})
     } for c in cs]
 
 @app.get("/chats")
-def list_chats(patient_id: Optional[str] = None, doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
-    query = db.query(Chat).filter_by(doctor_id=doctor_id)
+async def list_chats(
+    response: Response,
+    patient_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    summary: bool = False,
+    sort: str = Query("created", pattern="^(created|activity)$"),
+    doctor_id: str = Depends(get_doctor_id),
+    db: AsyncSession = Depends(get_async_db)
+):
+    query = select(Chat).filter_by(doctor_id=doctor_id)
     
     if patient_id:
         # Get chats for specific patient
@@ -331,19 +534,39 @@ def list_chats(patient_id: Optional[str] = None, doctor_id: str = Depends(get_do
         # If no patient_id specified, only get patient-specific chats (exclude general chats)
         query = query.filter(Chat.is_general != "true")
     
-    cs = query.order_by(Chat.created_at.desc()).all()
+    cs, overview = await list_chat_rows(db, query, response, limit, cursor, summary, sort)
     return [{
         "id": c.id, 
         "title": c.title, 
         "patient_id": c.patient_id,
         "patient_name": c.patient_name,
         "is_general": c.is_general == "true",
-        "created_at": c.created_at.isoformat()
+        "created_at": c.created_at.isoformat(),
+        **(chat_overview_fields(c) if overview else {})
     } for c in cs]
 
 @app.get("/messages")
-def list_messages(chat_id: str, doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
-    ms = db.query(Message).filter_by(chat_id=chat_id).order_by(Message.created_at.asc()).all()
+async def list_messages(
+    chat_id: str,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    doctor_id: str = Depends(get_doctor_id),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Messages in chronological order. With `limit`, returns the newest page and
+    an X-Next-Cursor that loads the page of older messages before it.
+    """
+    # Include turns a just-finished stream has queued for writing
+    await writebehind.flush_chat_async(chat_id)
+    query = select(Message).filter_by(chat_id=chat_id)
+    if limit or cursor:
+        ms, next_cursor = await paginate(db, query, Message, limit or MAX_PAGE_SIZE, cursor)
+        ms = list(reversed(ms))
+        set_next_cursor(response, next_cursor)
+    else:
+        ms = (await db.scalars(query.order_by(Message.created_at.asc()))).all()
     return [{
         "id": m.id, 
         "role": m.role, 
@@ -369,17 +592,16 @@ async def upload(file: UploadFile = File(...), doctor_id: str = Depends(get_doct
     unique_filename = f"{doctor_id}_{uuid.uuid4().hex[:8]}.{file_extension}"
     path = f"storage/{unique_filename}"
     
-    # Save file
-    async with aiofiles.open(path, "wb") as f:
-        content = await file.read()
-        await f.write(content)
+    # Stream to disk in chunks; identical content shares one blob
+    size, sha256 = await save_upload(file, path)
     
     # Determine file type
     mime_type = mimetypes.guess_type(file.filename or "")[0] or "application/octet-stream"
     file_info = {
         "url": f"/{path}",
         "filename": file.filename,
-        "size": len(content),
+        "size": size,
+        "sha256": sha256,
         "mime_type": mime_type,
         "is_audio": mime_type.startswith("audio/") or file_extension in ["webm", "wav", "mp3", "m4a"],
         "is_image": mime_type.startswith("image/")
@@ -415,14 +637,14 @@ class GenerateBody(BaseModel):
     temperature: Optional[float] = 0.2
     max_tokens: Optional[int] = 1024
 
-@app.post("/stream")
-def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
+def prepare_generation(body: GenerateBody, doctor_id: str, db: Session):
+    """Persist the user turn and assemble the upstream payload (and response cache key) for /stream"""
     # Get chat info for patient context
     chat = db.query(Chat).filter_by(id=body.chat_id, doctor_id=doctor_id).first()
     if not chat:
         raise HTTPException(404, "Chat not found")
     
-    # 1) persist user message with patient info
+    # 1) user message with patient info; written behind, after history is read
     user_message = Message(
         chat_id=body.chat_id,
         doctor_id=doctor_id,
@@ -430,7 +652,8 @@ def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id),
         patient_name=chat.patient_name,
         role="user", 
         text=body.prompt, 
-        media_url=body.image_url
+        media_url=body.image_url,
+        created_at=datetime.utcnow()
     )
     
     # Set media type if we have a file
@@ -442,35 +665,27 @@ def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id),
         else:
             user_message.media_type = "file"
     
-    db.add(user_message)
-    db.commit()
+    # Earlier turns of this chat may still be queued for writing
+    writebehind.flush_chat(body.chat_id)
 
-    # 2) Save user message to RAG context and retrieve relevant context
-    save_conversation_context(
-        doctor_id=doctor_id, 
-        patient_id=chat.patient_id, 
-        chat_id=body.chat_id,
-        role="user", 
-        text=body.prompt, 
-        patient_name=chat.patient_name
-    )
-    
-    # Retrieve relevant context
+    # 2) Retrieve relevant context
     ctx = retrieve_context(body.prompt, doctor_id, chat.patient_id)
 
-    # 3) Get recent conversation history for context
-    recent_messages = db.query(Message).filter_by(
-        chat_id=body.chat_id
-    ).order_by(Message.created_at.desc()).limit(10).all()
-    
-    # Reverse to get chronological order
-    recent_messages = recent_messages[::-1]
+    # 3) Get recent conversation history for context, newest first
+    # Turns already folded into the chat's rolling summary are sent as that summary
+    history_query = db.query(Message).filter(Message.chat_id == body.chat_id)
+    if chat.summary and chat.summarized_until:
+        history_query = history_query.filter(Message.created_at > chat.summarized_until)
+    recent_messages = history_query.order_by(Message.created_at.desc()).limit(PROMPT_HISTORY_MESSAGES).all()
+    # Queued ahead of the reply, so the two are written in order
+    writebehind.submit(user_message)
     
     # 4) build payload for OpenAI-compatible API
     messages = []
     
     # Build enhanced system message with patient context
     system_parts = [body.system]
+    notes = None
     
     # Add patient context if available
     if chat.patient_name:
@@ -479,25 +694,21 @@ def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id),
             # You could add patient medical history here from the database
             patient = db.query(Patient).filter_by(id=chat.patient_id).first()
             if patient and patient.notes:
-                system_parts.append(f"Patient notes: {patient.notes}")
+                notes = patient.notes
     else:
         system_parts.append("\n\nThis is a general medical consultation.")
     
-    # Add RAG context if available
-    if ctx:
-        citations = "\n".join([f"- {c['text'][:300]}" for c in ctx])
-        system_parts.append(f"\n\nRelevant context from previous conversations:\n{citations}")
-    
-    system_content = "".join(system_parts)
-    messages.append({"role": "system", "content": system_content})
-    
-    # Add recent conversation history (excluding the current message we just added)
-    for msg in recent_messages[:-1]:  # Skip the last message which is the current user message
-        if msg.text:  # Only include messages with text content
-            messages.append({
-                "role": msg.role,
-                "content": msg.text[:1000]  # Limit message length to avoid token limits
-            })
+    # Fill the context window by priority: system and notes, newest history, then RAG
+    is_image = bool(body.image_url) and any(
+        ext in body.image_url.lower() for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp'])
+    system_content, rag_context, history, breakdown = build_prompt(
+        "".join(system_parts), notes, recent_messages, ctx, body.prompt, body.max_tokens,
+        image=is_image, summary=chat.summary)
+    # Persist token counts computed for older messages so later turns reuse them
+    db.commit()
+    print(f"Prompt tokens for chat {chat.id}: {breakdown}")
+    messages.append({"role": "system", "content": system_content + rag_context})
+    messages.extend(history)
     
     # Add user message with text and optional image
     user_content = []
@@ -512,17 +723,15 @@ def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id),
             # For audio files, modify the text prompt to indicate audio processing is needed
             user_content[0]["text"] = f"{body.prompt}\n\n[Note: User has uploaded an audio file ({body.image_url}). Since I cannot directly process audio files, I should explain that they would need to transcribe the audio first, or suggest they describe what was said in the audio message.]"
         elif is_image:
-            # fetch and base64 the image for the model
+            # Uploaded images are read from local storage (no HTTP round-trip to
+            # ourselves) and their base64 payload is cached across turns
             try:
-                r = requests.get(body.image_url, timeout=10)
-                r.raise_for_status()
-                b64 = base64.b64encode(r.content).decode("utf-8")
                 user_content.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{b64}"}
+                    "image_url": {"url": image_data_url(body.image_url)}
                 })
             except Exception as e:
-                print(f"Failed to fetch image: {e}")
+                print(f"Failed to load image: {e}")
     
     # If only text, use simple string format
     if len(user_content) == 1:
@@ -539,19 +748,78 @@ def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id),
     }
     
     # Add API key header if using OpenAI
-    headers = {"Content-Type": "application/json"}
-    if "openai.com" in MODEL_ENDPOINT:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if api_key and api_key != "your-openai-api-key-here":
-            headers["Authorization"] = f"Bearer {api_key}"
+    headers = upstream.request_headers(MODEL_ENDPOINT)
+
+    # Deterministic requests may be answered from the response cache. RAG context
+    # is left out of the key: it is drawn from the doctor's own earlier turns,
+    # including previous asks of this very question, so it changes on every
+    # repeat. The key is scoped to the doctor instead.
+    cache_key = None
+    if response_cache.eligible(chat, body.temperature):
+        keyed = dict(payload, messages=[{"role": "system", "content": system_content}] + messages[1:])
+        cache_key = response_cache.key_for(MODEL_ENDPOINT, doctor_id, keyed)
+
+    return chat, payload, headers, cache_key
+
+# Appended to replies cut short because the client went away
+TRUNCATED_MARKER = "\n\n[truncated: client disconnected]"
+
+@app.post("/stream")
+async def stream_generate(body: GenerateBody, request: Request, doctor_id: str = Depends(get_doctor_id), db: Session = Depends(get_db)):
+    # DB work and prompt assembly are blocking, so they run in the threadpool;
+    # the upstream stream itself runs on the event loop and holds no thread.
+    # A reconnect re-attaches to its generation instead of starting another
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        generation, after = generations.resume(last_event_id, doctor_id)
+        return generation_response(generation, after, replay=True)
+
+    # A double tap or a retry joins the generation already running for it
+    key, derived_key = generations.request_keys(
+        doctor_id, body.chat_id, body.prompt, body.image_url, request.headers.get("idempotency-key")
+    )
+    existing = generations.find(key, derived_key, doctor_id)
+    if existing:
+        return generation_response(existing, 0, replay=True)
+
+    # Claim a model slot (or a queue place) first, so an overloaded worker sheds
+    # the request with a 429 before anything is persisted
+    ticket = admission.controller.acquire(doctor_id)
+    # Registered before the first await so simultaneous duplicates find it
+    generation = generations.create(body.chat_id, doctor_id, key, derived_key)
+    try:
+        chat, payload, headers, cache_key = await run_in_threadpool(prepare_generation, body, doctor_id, db)
+        cached = await run_in_threadpool(response_cache.get, cache_key) if cache_key else None
+    except BaseException as e:
+        admission.controller.release(ticket)
+        generation.fail(e.detail if isinstance(e, HTTPException) else "Could not start the generation")
+        raise
+    if cached is not None:
+        # Replays never reach the model
+        admission.controller.release(ticket)
 
     # 4) stream from model endpoint and tee to client + DB
-    def gen():
+    async def gen():
+        if cached is not None:
+            # Replay the stored deltas through the same output stage, without pacing
+            for token in cached:
+                yield sse.Delta(token)
+            await writebehind.submit_async(assistant_message(chat, doctor_id, "".join(cached)))
+            summaries.schedule(chat.id, model_router)
+            await writebehind.flush_chat_async(chat.id)
+            yield "event: end\ndata: [DONE]\n\n"
+            return
+
         buf = []
+        completed = False
         try:
-            with requests.post(MODEL_ENDPOINT, json=payload, headers=headers, stream=True, timeout=600) as r:
-                r.raise_for_status()
-                for line in r.iter_lines(decode_unicode=True):
+            # Routed to the least busy healthy replica, retried elsewhere if it
+            # fails before its first line reaches us
+            lines = model_router.stream_lines(upstream.get_client(), payload, headers)
+            # Leaving the `async with` closes the upstream response, which aborts
+            # the generation on the model server
+            async with contextlib.aclosing(lines):
+                async for line in lines:
                     if not line.strip(): continue
                     
                     # Handle OpenAI-style SSE format
@@ -564,7 +832,6 @@ def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id),
                         
                         try:
                             # Parse JSON response
-                            import json
                             chunk = json.loads(data)
                             
                             # Extract content from choices
@@ -574,57 +841,82 @@ def stream_generate(body: GenerateBody, doctor_id: str = Depends(get_doctor_id),
                                     token = choice["delta"]["content"]
                                     if token:  # Only yield non-empty tokens
                                         buf.append(token)
-                                        yield f"data: {token}\n\n"
+                                        yield sse.Delta(token)
                         except json.JSONDecodeError:
                             # Fallback: treat as plain text token
                             token = data
                             buf.append(token)
-                            yield f"data: {token}\n\n"
+                            yield sse.Delta(token)
+                completed = True
                             
+        except (asyncio.CancelledError, GeneratorExit):
+            # Cancelled once no client has been attached for the detach grace period
+            record_disconnect(chat, doctor_id, buf, body.max_tokens)
+            raise
         except Exception as e:
             # If model endpoint fails, yield demo response
             if "openai.com" in MODEL_ENDPOINT and (not os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY") == "your-openai-api-key-here"):
                 demo_response = "🏥 **Demo Mode**: This is a simulated AI response. To enable real AI responses, add your OpenAI API key to the environment variables. Based on your query, I can help with medical consultations, patient management, and health-related questions."
                 buf.append(demo_response)
-                yield f"data: {demo_response}\n\n"
+                yield sse.Delta(demo_response)
             else:
                 error_msg = f"Model endpoint error: {str(e)}"
                 buf.append(error_msg)
-                yield f"data: {error_msg}\n\n"
-        
+                yield sse.Delta(error_msg)
+
         # persist assistant message with patient info
         text = "".join(buf)
         if text.strip():  # Only save if we have content
-            assistant_message = Message(
-                chat_id=body.chat_id,
-                doctor_id=doctor_id,
-                patient_id=chat.patient_id,
-                patient_name=chat.patient_name,
-                role="assistant", 
-                text=text
-            )
-            db.add(assistant_message)
-            db.commit()
-            
-            # Save assistant response to RAG context
-            save_conversation_context(
-                doctor_id=doctor_id, 
-                patient_id=chat.patient_id, 
-                chat_id=body.chat_id,
-                role="assistant", 
-                text=text, 
-                patient_name=chat.patient_name
-            )
+            await writebehind.submit_async(assistant_message(chat, doctor_id, text))
+            # Condense older turns in the background once the chat grows long
+            summaries.schedule(chat.id, model_router)
+            if completed and cache_key:
+                await run_in_threadpool(response_cache.put, cache_key, buf)
+        # The turns are committed before the client hears the reply is over, so a
+        # follow-up read sees them whichever worker serves it
+        await writebehind.flush_chat_async(chat.id)
         yield "event: end\ndata: [DONE]\n\n"
 
-    return StreamingResponse(
-        gen(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "X-Accel-Buffering": "no",
-            "Connection": "keep-alive",
-        },
+    # Deltas are batched into JSON-encoded frames by the output stage; the
+    # generation runs on its own so a dropped client can pick it up again
+    generation.start(sse.coalesce(gen() if cached is not None else admission.admitted(ticket, gen())))
+    return generation_response(generation, 0, "hit" if cached is not None else ("miss" if cache_key else "bypass"))
+
+def generation_response(generation: generations.Generation, after: int, cache_status: Optional[str] = None,
+                        replay: bool = False) -> StreamingResponse:
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "Connection": "keep-alive",
+        "X-Generation-Id": generation.id,
+    }
+    if cache_status:
+        headers["X-Response-Cache"] = cache_status
+    return StreamingResponse(generation.subscribe(after, replay), media_type="text/event-stream", headers=headers)
+
+def record_disconnect(chat: Chat, doctor_id: str, buf: List[str], max_tokens: Optional[int]):
+    """Count an aborted generation and save what was streamed so far, marked as truncated"""
+    metrics.inc("stream_client_disconnects")
+    metrics.inc("stream_upstream_deltas_received_before_cancel", len(buf))
+    # Not tokens saved, only an upper bound on them: the rest of the max_tokens budget
+    metrics.inc("stream_upstream_tokens_cap_remaining", max(0, (max_tokens or 0) - len(buf)))
+    text = "".join(buf)
+    if text.strip():
+        message = assistant_message(chat, doctor_id, text + TRUNCATED_MARKER)
+        if not writebehind.submit(message, block=False):
+            # Not awaited: the cancelled response task cannot await anything else
+            asyncio.get_running_loop().run_in_executor(None, writebehind.submit, message)
+
+def assistant_message(chat: Chat, doctor_id: str, text: str) -> Message:
+    """The assistant reply as a Message for the write-behind queue; its token count is filled in there"""
+    return Message(
+        chat_id=chat.id,
+        doctor_id=doctor_id,
+        patient_id=chat.patient_id,
+        patient_name=chat.patient_name,
+        role="assistant", 
+        text=text,
+        created_at=datetime.utcnow()
     )
 
 # Test endpoint for debugging
@@ -647,10 +939,14 @@ def cors_test_options():
     """Handle preflight OPTIONS requests"""
     return {"message": "CORS preflight successful"}
 
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
 # Health check
 @app.get("/health")
 def health_check():
-    return {"status": "healthy", "model_endpoint": MODEL_ENDPOINT}
+    return {"status": "healthy", "model_endpoint": MODEL_ENDPOINT, "model_endpoints": model_router.status()}
 
 # ------------- Run -------------
 if __name__ == "__main__":
@@ -1,16 +1,91 @@
-import os, datetime
+import os, datetime, time, asyncio, threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+from fastapi import HTTPException
 from jose import jwt, JWTError
-from passlib.hash import bcrypt
+from passlib.context import CryptContext
+from cache import LRUCache
+import metrics
 
 JWT_SECRET = os.getenv("JWT_SECRET", "change-me")
 JWT_ALG = "HS256"
 JWT_EXP_MIN = 60 * 24 * 30  # 30 days for persistent login
+# Verified token -> claims, so polling clients skip the signature check on
+# every request. Entries never outlive the token's exp, nor AUTH_TOKEN_CACHE_TTL.
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("AUTH_TOKEN_CACHE_TTL", "300"))
+
+# bcrypt cost for new hashes. Existing hashes with a different cost are
+# re-hashed at this cost the next time their owner logs in.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Hashing runs in its own processes so a login wave burns those cores instead
+# of the request threadpool. Past workers + queue depth, callers get a fast 503.
+HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+HASH_QUEUE_DEPTH = int(os.getenv("AUTH_HASH_QUEUE_DEPTH", "32"))
+
+_claims = LRUCache(TOKEN_CACHE_SIZE)
+
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS)
 
 def make_hash(pw: str) -> str:
-    return bcrypt.hash(pw)
+    return pwd_context.hash(pw)
 
 def verify_hash(pw: str, hashed: str) -> bool:
-    return bcrypt.verify(pw, hashed)
+    return bool(hashed) and pwd_context.verify(pw, hashed)
+
+def verify_and_update(pw: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """(valid, new_hash): new_hash is set when the stored hash should be replaced"""
+    if not hashed:
+        return False, None
+    return pwd_context.verify_and_update(pw, hashed)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_inflight = 0
+
+def start_hash_pool():
+    """Create the hashing pool and fork its workers up front, before request threads exist"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+            for f in [_pool.submit(os.getpid) for _ in range(HASH_WORKERS)]:
+                f.result()
+
+def shutdown_hash_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+async def _run_in_hash_pool(fn, *args):
+    global _inflight
+    with _pool_lock:
+        if _inflight >= HASH_WORKERS + HASH_QUEUE_DEPTH:
+            metrics.inc("auth_hash_rejected")
+            raise HTTPException(503, "Authentication is busy, please retry", headers={"Retry-After": "1"})
+        _inflight += 1
+        metrics.set_gauge("auth_hash_inflight", _inflight)
+    start = time.perf_counter()
+    try:
+        if _pool is None:
+            start_hash_pool()
+        return await asyncio.wrap_future(_pool.submit(fn, *args))
+    finally:
+        with _pool_lock:
+            _inflight -= 1
+            metrics.set_gauge("auth_hash_inflight", _inflight)
+        metrics.observe("auth_hash_ms", (time.perf_counter() - start) * 1000)
+
+async def hash_password(pw: str) -> str:
+    return await _run_in_hash_pool(make_hash, pw)
+
+async def check_password(pw: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """Verify off the event loop; see verify_and_update"""
+    if not hashed:
+        return False, None
+    return await _run_in_hash_pool(verify_and_update, pw, hashed)
 
 def make_token(doctor_id: str, email: str) -> str:
     now = datetime.datetime.utcnow()
@@ -18,7 +93,18 @@ def make_token(doctor_id: str, email: str) -> str:
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALG)
 
 def read_token(token: str):
+    if TOKEN_CACHE_TTL > 0:
+        claims = _claims.get(token)
+        if claims is not None:
+            metrics.inc("auth_token_cache_hits")
+            return claims
+        metrics.inc("auth_token_cache_misses")
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
     except JWTError:
-        return None
\ No newline at end of file
+        return None
+    ttl = min(TOKEN_CACHE_TTL, claims.get("exp", 0) - time.time())
+    if ttl > 0:
+        _claims.put(token, claims, ttl=ttl)
+    return claims
+
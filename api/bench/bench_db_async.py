@@ -0,0 +1,167 @@
+"""
+Latency of /patients and /messages while many /stream generations are open.
+
+    cd api && python bench/bench_db_async.py --streams 200 --requests 2000
+    python bench/bench_db_async.py --api-dir /path/to/other/checkout/api   # compare trees
+
+A mock OpenAI-compatible upstream (slow enough that every stream stays open
+for the whole measurement) and the API are started as subprocesses on local
+ports, with a scratch SQLite database. Reports p50/p99 of each endpoint with
+no streams open, then with --streams open.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def run_mock_upstream(port: int, tokens: int, interval: float):
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import StreamingResponse
+    from starlette.routing import Route
+
+    async def completions(request):
+        count = min(tokens, (await request.json()).get("max_tokens") or tokens)
+
+        async def gen():
+            for i in range(count):
+                await asyncio.sleep(interval)
+                delta = {"choices": [{"delta": {"content": f"t{i} "}}]}
+                yield f"data: {json.dumps(delta)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(gen(), media_type="text/event-stream")
+
+    app = Starlette(routes=[Route("/v1/chat/completions", completions, methods=["POST"])])
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+def pct(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+async def wait_ready(url: str):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+async def probe(client: httpx.AsyncClient, headers: dict, paths, requests: int, concurrency: int):
+    latencies = {path: [] for path in paths}
+    todo = iter(range(requests))
+
+    async def worker():
+        for i in todo:
+            path = paths[i % len(paths)]
+            start = time.perf_counter()
+            r = await client.get(path, headers=headers)
+            r.raise_for_status()
+            latencies[path].append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+def report(label: str, latencies: dict):
+    for path, samples in latencies.items():
+        name = path.split("?")[0]
+        print(f"{label:14} {name:10} p50 {pct(samples, 0.5):7.1f} ms   p99 {pct(samples, 0.99):7.1f} ms")
+
+async def main(args):
+    mock = subprocess.Popen([sys.executable, __file__, "--mock-upstream", "--port", str(args.port),
+                             "--interval", str(args.interval)])
+    port = args.port + 1
+    with tempfile.TemporaryDirectory() as workdir:
+        env = {
+            **os.environ,
+            "PYTHONPATH": args.api_dir,
+            "DB_URL": f"sqlite:///{workdir}/bench.db",
+            "MODEL_ENDPOINT": f"http://127.0.0.1:{args.port}/v1/chat/completions",
+            "ADMISSION_MAX_INFLIGHT": str(args.streams * 2),
+            "ADMISSION_MAX_QUEUED_PER_DOCTOR": str(args.streams * 2),
+            "SUMMARY_TRIGGER_MESSAGES": "0",
+            "BCRYPT_ROUNDS": "4",
+        }
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        base = f"http://127.0.0.1:{port}"
+        streams = []
+        try:
+            await wait_ready(f"http://127.0.0.1:{args.port}/")
+            await wait_ready(base + "/healthz")
+            limits = httpx.Limits(max_connections=args.streams + args.concurrency + 10)
+            async with httpx.AsyncClient(base_url=base, limits=limits, timeout=120) as client:
+                r = await client.post("/auth/register", json={"email": f"{uuid.uuid4().hex}@bench", "password": "pw"})
+                headers = {"Authorization": f"Bearer {r.json()['token']}"}
+                for i in range(50):
+                    await client.post("/patients", json={"name": f"Patient {i}", "notes": "bench"}, headers=headers)
+                chat_id = (await client.post("/chats/general", headers=headers)).json()["id"]
+                # A short generation gives /messages something to return
+                await client.post("/stream", headers=headers,
+                                  json={"chat_id": chat_id, "prompt": "seed", "max_tokens": 16})
+                paths = ["/patients?limit=50", f"/messages?chat_id={chat_id}&limit=50"]
+
+                await probe(client, headers, paths, 100, args.concurrency)  # warm up
+                report("idle", await probe(client, headers, paths, args.requests, args.concurrency))
+
+                opened = 0
+                all_open = asyncio.Event()
+
+                async def one(i):
+                    nonlocal opened
+                    # Distinct prompts, so the streams are not collapsed into one generation
+                    async with client.stream("POST", "/stream", headers=headers,
+                                             json={"chat_id": chat_id, "prompt": f"question {i}",
+                                                   "max_tokens": 100000}) as resp:
+                        chunks = resp.aiter_bytes()
+                        await chunks.__anext__()
+                        opened += 1
+                        if opened == args.streams:
+                            all_open.set()
+                        async for _ in chunks:
+                            pass
+
+                streams = [asyncio.create_task(one(i)) for i in range(args.streams)]
+                await asyncio.wait_for(all_open.wait(), 120)
+                report(f"{args.streams} streams", await probe(client, headers, paths, args.requests, args.concurrency))
+                still_open = sum(1 for t in streams if not t.done())
+                print(f"({still_open} of {args.streams} streams still open at the end)")
+        finally:
+            for t in streams:
+                t.cancel()
+            server.terminate()
+            server.wait()
+            mock.terminate()
+            mock.wait()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000, help="probe requests per phase")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent probe requests")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between upstream tokens")
+    parser.add_argument("--port", type=int, default=18750)
+    parser.add_argument("--api-dir", default=API_DIR, help="api/ directory of the tree to run")
+    parser.add_argument("--mock-upstream", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mock_upstream:
+        # Long enough to outlast the measurement
+        run_mock_upstream(args.port, 100000, args.interval)
+    else:
+        asyncio.run(main(args))
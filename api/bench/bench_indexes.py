@@ -0,0 +1,147 @@
+"""
+Query plans and latencies for the hot list queries, before and after the
+0001_hot_path_indexes migration, on a seeded database.
+
+    cd api && python bench/bench_indexes.py                      # 1M messages, SQLite
+    python bench/bench_indexes.py --db postgresql://.../medra_bench --messages 1000000
+
+The database is dropped and reseeded, so it never comes from the app's DB_URL:
+it is --db (or BENCH_DB_URL), by default a scratch SQLite file, and its name
+must contain "bench".
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+SCRATCH_DB = "sqlite:///./bench_indexes.db"
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=os.getenv("BENCH_DB_URL", SCRATCH_DB),
+                        help="scratch database to drop and reseed; its name must contain 'bench'")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--doctors", type=int, default=100)
+    parser.add_argument("--chats-per-doctor", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=20)
+    return parser.parse_args()
+
+def check_scratch(db_url: str, app_db: Optional[str] = None):
+    """Refuse to wipe anything but a scratch database"""
+    url = make_url(db_url)
+    name = os.path.basename(url.database or "")
+    if "bench" not in name.lower():
+        sys.exit(f"Refusing to drop {url.render_as_string()}: its database name must contain 'bench'")
+    if app_db and make_url(app_db) == url:
+        sys.exit(f"Refusing to drop {url.render_as_string()}: it is the app's DB_URL")
+
+# models reads DB_URL at import, so the scratch target is checked and set first
+ARGS = parse_args() if __name__ == "__main__" else None
+if ARGS:
+    check_scratch(ARGS.db, os.getenv("DB_URL"))
+    os.environ["DB_URL"] = ARGS.db
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from models import Base, engine, Doctor, Patient, Chat, Message
+import migrations
+
+QUERIES = {
+    "messages by chat (/messages)":
+        "SELECT * FROM messages WHERE chat_id = :chat_id ORDER BY created_at ASC",
+    "recent history (/stream)":
+        "SELECT * FROM messages WHERE chat_id = :chat_id ORDER BY created_at DESC LIMIT 10",
+    "general chats (/chats/general)":
+        "SELECT * FROM chats WHERE doctor_id = :doctor_id AND is_general = 'true' ORDER BY created_at DESC",
+    "patients (/patients)":
+        "SELECT * FROM patients WHERE doctor_id = :doctor_id ORDER BY created_at DESC",
+    "patient messages (profile)":
+        "SELECT * FROM messages WHERE patient_id = :patient_id AND doctor_id = :doctor_id "
+        "ORDER BY created_at DESC LIMIT 10",
+}
+
+def seed(messages: int, doctors: int, chats_per_doctor: int):
+    check_scratch(engine.url.render_as_string(hide_password=False))
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    rng = random.Random(0)
+    start = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        doctor_ids = [str(uuid.uuid4()) for _ in range(doctors)]
+        conn.execute(Doctor.__table__.insert(), [{"id": d, "email": f"{d}@bench"} for d in doctor_ids])
+        patients, chats = [], []
+        for d in doctor_ids:
+            for _ in range(chats_per_doctor // 2):
+                patients.append({"id": str(uuid.uuid4()), "doctor_id": d, "name": "P", "created_at": start})
+            for i in range(chats_per_doctor):
+                p = rng.choice(patients[-(chats_per_doctor // 2):]) if i % 2 else None
+                chats.append({"id": str(uuid.uuid4()), "doctor_id": d, "patient_id": p and p["id"],
+                              "is_general": "false" if p else "true", "title": "c",
+                              "created_at": start + timedelta(minutes=i)})
+        conn.execute(Patient.__table__.insert(), patients)
+        conn.execute(Chat.__table__.insert(), chats)
+    batch = []
+    for i in range(messages):
+        c = rng.choice(chats)
+        batch.append({"id": str(uuid.uuid4()), "chat_id": c["id"], "doctor_id": c["doctor_id"],
+                      "patient_id": c["patient_id"], "role": "user" if i % 2 else "assistant",
+                      "text": "x" * 200, "created_at": start + timedelta(seconds=i)})
+        if len(batch) == 20000:
+            with engine.begin() as conn:
+                conn.execute(Message.__table__.insert(), batch)
+            batch = []
+    if batch:
+        with engine.begin() as conn:
+            conn.execute(Message.__table__.insert(), batch)
+    return chats
+
+def drop_indexes():
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for ix in table.indexes:
+                conn.execute(text(f"DROP INDEX IF EXISTS {ix.name}"))
+        conn.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+
+def explain(conn, sql: str, params: dict) -> str:
+    if engine.dialect.name == "sqlite":
+        rows = conn.execute(text("EXPLAIN QUERY PLAN " + sql), params).fetchall()
+        return "; ".join(row[-1] for row in rows)
+    rows = conn.execute(text("EXPLAIN " + sql), params).fetchall()
+    return "; ".join(row[0].strip() for row in rows[:3])
+
+def measure(label: str, chats: list, runs: int):
+    rng = random.Random(1)
+    print(f"\n== {label} ==")
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            samples = []
+            for _ in range(runs):
+                c = rng.choice([c for c in chats if c["patient_id"]])
+                params = {"chat_id": c["id"], "doctor_id": c["doctor_id"], "patient_id": c["patient_id"]}
+                t = time.perf_counter()
+                conn.execute(text(sql), params).fetchall()
+                samples.append((time.perf_counter() - t) * 1000)
+            print(f"{name:32} p50 {statistics.median(samples):8.2f} ms  max {max(samples):8.2f} ms")
+            print(f"{'':32} plan: {explain(conn, sql, params)}")
+
+def main(args):
+    t = time.perf_counter()
+    chats = seed(args.messages, args.doctors, args.chats_per_doctor)
+    print(f"Seeded {args.messages} messages in {time.perf_counter() - t:.1f}s ({engine.url.render_as_string()})")
+
+    drop_indexes()
+    measure("before (primary keys only)", chats, args.runs)
+    t = time.perf_counter()
+    migrations.run_migrations(engine)
+    print(f"\nMigrations applied in {time.perf_counter() - t:.1f}s")
+    measure("after migrations", chats, args.runs)
+
+if __name__ == "__main__":
+    main(ARGS)
@@ -0,0 +1,94 @@
+"""
+Login throughput under concurrent load, with a cheap endpoint probed alongside
+to show whether password hashing stalls other requests.
+
+    cd api && python bench/bench_login.py --concurrency 64 --seconds 10
+    AUTH_HASH_WORKERS=4 AUTH_HASH_QUEUE_DEPTH=16 python bench/bench_login.py
+    python bench/bench_login.py --url http://127.0.0.1:8000   # against a running server
+
+In-process runs use a scratch SQLite database in the current directory.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+os.environ.setdefault("DB_URL", "sqlite:///./bench_login.db")
+os.environ.setdefault("MODEL_ENDPOINT", "http://127.0.0.1:9/v1/chat/completions")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import httpx
+
+def pct(samples, q):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+async def run(client: httpx.AsyncClient, args):
+    users = [(f"bench-{uuid.uuid4().hex[:8]}@bench", "correct horse") for _ in range(args.users)]
+    for email, pw in users:
+        r = await client.post("/auth/register", json={"email": email, "password": pw})
+        r.raise_for_status()
+
+    latencies, probes, statuses = [], [], {}
+    deadline = time.perf_counter() + args.seconds
+
+    async def login_worker(i):
+        email, pw = users[i % len(users)]
+        while time.perf_counter() < deadline:
+            t = time.perf_counter()
+            r = await client.post("/auth/login", json={"email": email, "password": pw})
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+            if r.status_code == 200:
+                latencies.append((time.perf_counter() - t) * 1000)
+            elif r.status_code == 503:
+                await asyncio.sleep(0.05)
+
+    async def probe():
+        while time.perf_counter() < deadline:
+            t = time.perf_counter()
+            await client.get("/healthz")
+            probes.append((time.perf_counter() - t) * 1000)
+            await asyncio.sleep(0.05)
+
+    start = time.perf_counter()
+    await asyncio.gather(probe(), *(login_worker(i) for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    ok = statuses.get(200, 0)
+    print(f"concurrency {args.concurrency}, {elapsed:.1f}s: {ok / elapsed:.1f} logins/s, statuses {statuses}")
+    print(f"login   p50 {pct(latencies, 0.5):8.1f} ms  p99 {pct(latencies, 0.99):8.1f} ms")
+    print(f"healthz p50 {pct(probes, 0.5):8.1f} ms  p99 {pct(probes, 0.99):8.1f} ms  max {max(probes or [0]):.1f} ms")
+    if latencies:
+        print(f"login mean {statistics.mean(latencies):.1f} ms over {len(latencies)} requests")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process app")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--users", type=int, default=8)
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+            await run(client, args)
+        return
+
+    from app import app
+    from auth import HASH_WORKERS, HASH_QUEUE_DEPTH, BCRYPT_ROUNDS
+    from models import init_db
+    init_db()
+    print(f"in-process: {HASH_WORKERS} hash workers, queue depth {HASH_QUEUE_DEPTH}, bcrypt rounds {BCRYPT_ROUNDS}")
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", limits=limits, timeout=60) as client:
+            await run(client, args)
+
+if __name__ == "__main__":
+    asyncio.run(main())
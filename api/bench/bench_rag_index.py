@@ -0,0 +1,67 @@
+"""
+Micro-benchmark: resident inverted index vs. the original linear keyword scan.
+
+    cd api && python bench/bench_rag_index.py
+
+The scan timing replays the pre-index algorithm over an already-parsed store, so
+it excludes the json.load of conversation_store.json the old path also paid.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import rag
+
+TERMS = [
+    'symptom', 'pain', 'fever', 'headache', 'nausea', 'vomiting', 'diarrhea',
+    'blood pressure', 'hypertension', 'diabetes', 'medication', 'treatment',
+    'diagnosis', 'chest pain', 'shortness of breath', 'fatigue', 'dizziness',
+    'heart rate', 'pulse', 'temperature', 'weight', 'appetite', 'sleep',
+    'allergy', 'rash', 'swelling', 'infection', 'inflammation', 'chronic',
+    'acute', 'prescription', 'dosage', 'side effect', 'contraindication',
+] + [f"condition{i}itis" for i in range(500)]
+PATIENTS = [f"patient-{i}" for i in range(50)] + [None]
+QUERIES = 200
+
+def make_messages(n: int):
+    rng = random.Random(n)
+    return [(i + 1, rng.choice(PATIENTS), rng.sample(TERMS, rng.randint(0, 6))) for i in range(n)]
+
+def linear_scan(store: dict, query_keywords, patient_id):
+    relevant = []
+    for message_id, m in store.items():
+        if patient_id and m['patient_id'] != patient_id:
+            continue
+        overlap = set(query_keywords) & set(m['keywords'])
+        if overlap:
+            relevant.append((len(overlap) / len(query_keywords), message_id))
+    relevant.sort(reverse=True)
+    return relevant[:3]
+
+def timed(fn, queries) -> float:
+    start = time.perf_counter()
+    for q, p in queries:
+        fn(q, p)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+def main():
+    rng = random.Random(0)
+    queries = [(rng.sample(TERMS[:34], 2), rng.choice(PATIENTS[:5] + [None])) for _ in range(QUERIES)]
+    print(f"{'messages':>9} {'scan us/q':>11} {'index us/q':>11} {'speedup':>8}")
+    for n in (1_000, 10_000, 100_000):
+        rag.MAX_MESSAGES_PER_DOCTOR = n
+        messages = make_messages(n)
+        store = {mid: {"patient_id": pid, "keywords": kws} for mid, pid, kws in messages}
+        index = rag.DoctorIndex("bench")
+        for mid, pid, kws in messages:
+            index.add(mid, pid, rag._encode_keywords(kws).split())
+        encoded = [(rag._encode_keywords(q).split(), p) for q, p in queries]
+        scan_us = timed(lambda q, p: linear_scan(store, q, p), queries)
+        index_us = timed(lambda q, p: index.search(q, p, 3), encoded)
+        print(f"{n:>9} {scan_us:>11.1f} {index_us:>11.1f} {scan_us / index_us:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
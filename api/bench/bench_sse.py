@@ -0,0 +1,147 @@
+"""
+Per-stream server CPU and write syscalls for /stream, with one SSE frame per
+token (coalescing off) versus coalesced frames.
+
+    cd api && python bench/bench_sse.py --streams 200 --tokens 300
+    python bench/bench_sse.py --api-dir /path/to/other/checkout/api   # compare trees
+
+A mock OpenAI-compatible upstream and the API are started as subprocesses on
+local ports. CPU comes from /proc/<pid>/stat and write syscalls from
+/proc/<pid>/io, so this runs on Linux only.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def run_mock_upstream(port: int, tokens: int, interval: float):
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import StreamingResponse
+    from starlette.routing import Route
+
+    async def completions(request):
+        async def gen():
+            for i in range(tokens):
+                await asyncio.sleep(interval)
+                delta = {"choices": [{"delta": {"content": f"t{i} "}}]}
+                yield f"data: {json.dumps(delta)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(gen(), media_type="text/event-stream")
+
+    app = Starlette(routes=[Route("/v1/chat/completions", completions, methods=["POST"])])
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+def proc_usage(pid: int):
+    """(cpu seconds, write syscalls) of a process so far"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    with open(f"/proc/{pid}/io") as f:
+        io = dict(line.split(": ") for line in f.read().splitlines())
+    return cpu, int(io["syscw"])
+
+async def wait_ready(url: str):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+async def measure(label: str, env: dict, args, workdir: str):
+    port = args.port + 1
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env={**os.environ, "PYTHONPATH": args.api_dir, **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        await wait_ready(base + "/healthz")
+        limits = httpx.Limits(max_connections=args.streams + 10)
+        async with httpx.AsyncClient(base_url=base, limits=limits, timeout=600) as client:
+            r = await client.post("/auth/register", json={"email": f"{uuid.uuid4().hex}@bench", "password": "pw"})
+            headers = {"Authorization": f"Bearer {r.json()['token']}"}
+            chat_id = (await client.post("/chats/general", headers=headers)).json()["id"]
+
+            frames, ttfts = [], []
+
+            async def one():
+                start = time.perf_counter()
+                count = 0
+                async with client.stream("POST", "/stream", headers=headers,
+                                         json={"chat_id": chat_id, "prompt": "hi", "temperature": 0.7}) as resp:
+                    async for chunk in resp.aiter_text():
+                        if count == 0:
+                            ttfts.append((time.perf_counter() - start) * 1000)
+                        count += chunk.count("\n\n")
+                frames.append(count)
+
+            cpu0, writes0 = proc_usage(server.pid)
+            await asyncio.gather(*(one() for _ in range(args.streams)))
+            cpu1, writes1 = proc_usage(server.pid)
+
+        n = args.streams
+        print(f"{label:10} cpu/stream {(cpu1 - cpu0) * 1000 / n:7.2f} ms   "
+              f"write syscalls/stream {(writes1 - writes0) / n:7.1f}   "
+              f"frames/stream {statistics.mean(frames):6.1f}   "
+              f"ttft p50 {statistics.median(ttfts):6.1f} ms")
+    finally:
+        server.terminate()
+        server.wait()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between upstream tokens")
+    parser.add_argument("--port", type=int, default=18700)
+    parser.add_argument("--api-dir", default=API_DIR, help="api/ directory of the tree to run")
+    parser.add_argument("--mock-upstream", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+async def main(args):
+    mock = subprocess.Popen([sys.executable, __file__, "--mock-upstream", "--port", str(args.port),
+                             "--tokens", str(args.tokens), "--interval", str(args.interval)])
+    try:
+        await wait_ready(f"http://127.0.0.1:{args.port}/")
+        print(f"{args.streams} concurrent streams of {args.tokens} tokens, one every {args.interval * 1000:.0f} ms")
+        common = {
+            "MODEL_ENDPOINT": f"http://127.0.0.1:{args.port}/v1/chat/completions",
+            "ADMISSION_MAX_INFLIGHT": str(args.streams * 2),
+            "ADMISSION_MAX_QUEUED_PER_DOCTOR": str(args.streams * 2),
+            "SUMMARY_TRIGGER_MESSAGES": "0",
+            "BCRYPT_ROUNDS": "4",
+            # Every stream sends the same prompt; each must be its own generation
+            "GENERATION_DEDUP_WINDOW": "0",
+        }
+        for label, env in [
+            ("per-token", {"SSE_COALESCE_MS": "0"}),
+            ("coalesced", {}),
+        ]:
+            with tempfile.TemporaryDirectory() as workdir:
+                await measure(label, {**common, **env, "DB_URL": f"sqlite:///{workdir}/bench.db"}, args, workdir)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mock_upstream:
+        run_mock_upstream(args.port, args.tokens, args.interval)
+    else:
+        asyncio.run(main(args))
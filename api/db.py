@@ -1,17 +1,58 @@
+import os
+from typing import Optional
 from fastapi import Depends, HTTPException, status, Header
-from sqlalchemy.orm import Session
-from models import SessionLocal
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import SessionLocal, AsyncSessionLocal, Doctor
 from auth import read_token
+from cache import LRUCache
+import metrics
+
+# Doctor profiles by id, for endpoints that only read them (/auth/me, /auth/refresh).
+# Writers call invalidate_doctor; other workers see a change within the TTL.
+DOCTOR_CACHE_SIZE = int(os.getenv("AUTH_DOCTOR_CACHE_SIZE", "10000"))
+DOCTOR_CACHE_TTL = float(os.getenv("AUTH_DOCTOR_CACHE_TTL", "60"))
+
+_doctors = LRUCache(DOCTOR_CACHE_SIZE)
 
 def get_db():
     db = SessionLocal()
     try: yield db
     finally: db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def get_doctor_id(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing token")
     token = authorization.split(" ", 1)[1]
     payload = read_token(token)
     if not payload: raise HTTPException(status_code=401, detail="Invalid token")
-    return payload["sub"]
\ No newline at end of file
+    return payload["sub"]
+
+async def get_doctor_profile(db: AsyncSession, doctor_id: str) -> Optional[dict]:
+    """The doctor's profile fields as a dict, or None if there is no such doctor"""
+    if DOCTOR_CACHE_TTL > 0:
+        profile = _doctors.get(doctor_id)
+        if profile is not None:
+            metrics.inc("auth_doctor_cache_hits")
+            return profile
+        metrics.inc("auth_doctor_cache_misses")
+    doc = await db.get(Doctor, doctor_id)
+    if not doc:
+        return None
+    profile = {
+        "doctor_id": doc.id,
+        "name": doc.name,
+        "email": doc.email,
+        "avatar_url": doc.avatar_url,
+        "specialty": doc.specialty,
+        "phone": doc.phone,
+    }
+    if DOCTOR_CACHE_TTL > 0:
+        _doctors.put(doctor_id, profile, ttl=DOCTOR_CACHE_TTL)
+    return profile
+
+def invalidate_doctor(doctor_id: str):
+    _doctors.pop(doctor_id)
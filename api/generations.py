@@ -0,0 +1,220 @@
+"""
+Resumable generations.
+
+Each /stream generation runs as its own task, detached from the connection
+that started it, and keeps its SSE frames in a bounded ring buffer. Every
+frame carries an `id: <generation>:<seq>` field; a client whose connection
+dropped re-sends the request with `Last-Event-ID` and gets the frames it
+missed, then the live ones, without a new user message or a new model call.
+A generation with nobody attached is cancelled after GENERATION_DETACH_GRACE
+seconds. Finished generations stay available for GENERATION_RESUME_TTL.
+
+Identical requests are collapsed onto one generation. A request matches
+an earlier one with the same Idempotency-Key header for as long as that
+generation can be replayed, or, whatever key it carries, one with the same
+chat, prompt and attachment that is still running and started less than
+GENERATION_DEDUP_WINDOW seconds ago. So a double tap merges even when the
+client sends a fresh key per call. The generation is registered before the
+user turn is persisted, so even simultaneous duplicates share it.
+
+State is per worker, so resuming needs the reconnect to reach the same
+worker (sticky sessions) when running more than one.
+"""
+import asyncio
+import collections
+import hashlib
+import os
+import time
+import uuid
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+import metrics
+import sse
+
+# Seconds a generation keeps running with no client attached
+GENERATION_DETACH_GRACE = float(os.getenv("GENERATION_DETACH_GRACE", "30"))
+# Seconds a finished generation can still be replayed
+GENERATION_RESUME_TTL = float(os.getenv("GENERATION_RESUME_TTL", "300"))
+# Frames kept per generation; older ones can no longer be replayed
+GENERATION_BUFFER_FRAMES = int(os.getenv("GENERATION_BUFFER_FRAMES", "1024"))
+# Seconds within which a repeat of the same prompt joins the running generation; 0 disables
+GENERATION_DEDUP_WINDOW = float(os.getenv("GENERATION_DEDUP_WINDOW", "10"))
+
+class Generation:
+    """Per-worker; runs on the event loop, so no locking is needed"""
+
+    def __init__(self, chat_id: str, doctor_id: str, key: Optional[str] = None, derived_key: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.chat_id = chat_id
+        self.doctor_id = doctor_id
+        self.key = key  # from the client's Idempotency-Key
+        self.derived_key = derived_key  # from the chat, prompt and attachment
+        self.started_at = time.monotonic()
+        self.frames = collections.deque(maxlen=GENERATION_BUFFER_FRAMES)  # (seq, frame)
+        self.last_seq = 0
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._detach_timer: Optional[asyncio.TimerHandle] = None
+
+    def _append(self, frame: str):
+        self.last_seq += 1
+        self.frames.append((self.last_seq, f"id: {self.id}:{self.last_seq}\n{frame}"))
+        self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def start(self, stream: AsyncIterator[str]):
+        """Run an SSE frame stream as this generation"""
+        self.task = asyncio.create_task(self._run(stream))
+
+    def fail(self, error: str):
+        """End a generation that never started, e.g. because its request was rejected"""
+        self._append(sse.event("error", {"error": error}))
+        # A retry should try again rather than replay the failure
+        _unregister(self)
+        self._finish()
+
+    def _finish(self):
+        self.done = True
+        self._wake()
+        _active.discard(self.id)
+        metrics.set_gauge("generations_active", len(_active))
+        asyncio.get_running_loop().call_later(GENERATION_RESUME_TTL, _forget, self)
+
+    async def _run(self, stream: AsyncIterator[str]):
+        try:
+            async for frame in stream:
+                self._append(frame)
+        except asyncio.CancelledError:
+            # Abandoned; a late reconnect gets the partial reply and this, not a hang
+            self._append(sse.event("error", {"error": "Generation cancelled after the client disconnected"}))
+        except Exception as e:
+            print(f"Generation {self.id} failed: {e!r}")
+            self._append(sse.event("error", {"error": "Generation failed"}))
+        finally:
+            self._finish()
+
+    def replayable(self, after: int) -> bool:
+        """Whether every frame after `after` is still buffered"""
+        first = self.frames[0][0] if self.frames else self.last_seq + 1
+        return 0 <= after <= self.last_seq and after + 1 >= first
+
+    def _abandon(self):
+        self._detach_timer = None
+        if not self.subscribers and not self.done and self.task:
+            metrics.inc("generations_abandoned")
+            self.task.cancel()
+
+    async def subscribe(self, after: int = 0, replay: bool = False) -> AsyncIterator[str]:
+        """
+        Frames after sequence number `after`, then live ones until the generation
+        ends. `replay` marks a resume or a join, whose catch-up frames are counted.
+        """
+        self.subscribers += 1
+        if self._detach_timer:
+            self._detach_timer.cancel()
+            self._detach_timer = None
+        # Frames already buffered when a resuming or joining client attached are a replay
+        buffered_until = self.last_seq if replay else 0
+        replayed = 0
+        try:
+            seq = after
+            while True:
+                changed = self._changed
+                if not self.replayable(seq):
+                    # This client fell further behind than the buffer reaches
+                    yield sse.event("error", {"error": "Stream fell too far behind to resume"})
+                    return
+                for frame_seq, frame in list(self.frames):
+                    if frame_seq > seq:
+                        seq = frame_seq
+                        if frame_seq <= buffered_until:
+                            replayed += 1
+                        yield frame
+                if self.done and seq >= self.last_seq:
+                    return
+                if seq >= self.last_seq:
+                    await changed.wait()
+        finally:
+            if replayed:
+                metrics.inc("generation_frames_replayed", replayed)
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                # Give a dropped client a chance to come back before giving up on the model call
+                if GENERATION_DETACH_GRACE > 0:
+                    self._detach_timer = asyncio.get_running_loop().call_later(
+                        GENERATION_DETACH_GRACE, self._abandon
+                    )
+                else:
+                    self._abandon()
+
+_generations: Dict[str, Generation] = {}
+_by_key: Dict[str, Generation] = {}
+_active = set()
+
+def _unregister(generation: Generation):
+    for key in (generation.key, generation.derived_key):
+        if key and _by_key.get(key) is generation:
+            del _by_key[key]
+
+def _forget(generation: Generation):
+    _generations.pop(generation.id, None)
+    _unregister(generation)
+
+def _hash(*material: str) -> str:
+    return hashlib.sha256("\0".join(material).encode("utf-8")).hexdigest()
+
+def request_keys(doctor_id: str, chat_id: str, prompt: str, image_url: Optional[str],
+                 idempotency_key: Optional[str]) -> Tuple[Optional[str], str]:
+    """(key from the client's Idempotency-Key if sent, key derived from the request) for one /stream request"""
+    key = _hash("key", doctor_id, idempotency_key) if idempotency_key else None
+    return key, _hash("request", doctor_id, chat_id, prompt, image_url or "")
+
+def find(key: Optional[str], derived_key: str, doctor_id: str) -> Optional[Generation]:
+    """The generation an identical earlier request started, if a repeat should join it"""
+    generation = _by_key.get(key) if key else None
+    via = "idempotency_key"
+    if generation is None or generation.doctor_id != doctor_id:
+        generation = _by_key.get(derived_key)
+        via = "derived"
+        if generation is None or generation.doctor_id != doctor_id:
+            return None
+        if generation.done or time.monotonic() - generation.started_at > GENERATION_DEDUP_WINDOW:
+            return None
+    metrics.inc("generations_collapsed")
+    metrics.inc("generations_collapsed:" + via)
+    return generation
+
+def create(chat_id: str, doctor_id: str, key: Optional[str] = None, derived_key: Optional[str] = None) -> Generation:
+    """Register a generation (and its request keys) ahead of starting it"""
+    generation = Generation(chat_id, doctor_id, key, derived_key)
+    _generations[generation.id] = generation
+    if key:
+        _by_key[key] = generation
+    if derived_key and GENERATION_DEDUP_WINDOW > 0:
+        _by_key[derived_key] = generation
+    _active.add(generation.id)
+    metrics.inc("generations_started")
+    metrics.set_gauge("generations_active", len(_active))
+    return generation
+
+def resume(last_event_id: str, doctor_id: str) -> Tuple[Generation, int]:
+    """The generation a `Last-Event-ID` refers to, and the last sequence number the client saw"""
+    generation_id, _, seq = last_event_id.strip().partition(":")
+    generation = _generations.get(generation_id)
+    if generation is None or generation.doctor_id != doctor_id:
+        raise HTTPException(404, "Generation not found or expired")
+    try:
+        after = int(seq or 0)
+    except ValueError:
+        raise HTTPException(400, "Malformed Last-Event-ID")
+    if not generation.replayable(after):
+        raise HTTPException(410, "Generation can no longer be resumed from this point")
+    metrics.inc("generations_resumed")
+    return generation, after
@@ -0,0 +1,124 @@
+import base64
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from google.auth import jwt as google_jwt
+
+import metrics
+
+# Process-wide cache of Google's ID token signing certificates. Fresh for the
+# endpoint's Cache-Control max-age, refreshed in the background shortly before
+# that runs out, and served stale for a while if Google cannot be reached.
+GOOGLE_CERTS_URL = os.getenv("GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs")
+# Start a background refresh this many seconds before the certs go stale
+GOOGLE_CERTS_REFRESH_MARGIN = float(os.getenv("GOOGLE_CERTS_REFRESH_MARGIN", "300"))
+# How long past expiry stale certs may still be used while fetches fail
+GOOGLE_CERTS_MAX_STALE = float(os.getenv("GOOGLE_CERTS_MAX_STALE", "3600"))
+GOOGLE_CERTS_TIMEOUT = float(os.getenv("GOOGLE_CERTS_TIMEOUT", "5"))
+# Tokens with an unknown key id force a refetch at most this often
+FORCED_REFRESH_INTERVAL = 60
+DEFAULT_MAX_AGE = 3600
+
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+_certs: Optional[Dict[str, str]] = None
+_expires_at = 0.0
+_fetched_at = float("-inf")
+_lock = threading.Lock()
+_fetch_lock = threading.Lock()  # one synchronous fetch at a time
+_refreshing = False
+
+def _max_age(cache_control: str) -> float:
+    m = re.search(r"max-age=(\d+)", cache_control or "")
+    return float(m.group(1)) if m else DEFAULT_MAX_AGE
+
+def _fetch():
+    global _certs, _expires_at, _fetched_at
+    start = time.perf_counter()
+    try:
+        r = requests.get(GOOGLE_CERTS_URL, timeout=GOOGLE_CERTS_TIMEOUT)
+        r.raise_for_status()
+        certs = r.json()
+    except (requests.RequestException, ValueError):
+        metrics.inc("google_certs_fetch_errors")
+        raise
+    finally:
+        metrics.observe("google_certs_fetch_ms", (time.perf_counter() - start) * 1000)
+    with _lock:
+        _certs = certs
+        _fetched_at = time.monotonic()
+        _expires_at = _fetched_at + _max_age(r.headers.get("Cache-Control", ""))
+    metrics.inc("google_certs_fetches")
+
+def _background_refresh():
+    global _refreshing
+    try:
+        _fetch()
+    except Exception as e:
+        print(f"Google certs refresh failed, serving cached certs: {e}")
+    finally:
+        _refreshing = False
+
+def _cached(now: float, force: bool) -> Optional[Dict[str, str]]:
+    """Fresh cached certs, kicking off a background refresh when they are about to expire"""
+    global _refreshing
+    with _lock:
+        if force and now - _fetched_at >= FORCED_REFRESH_INTERVAL:
+            return None
+        if _certs is None or now >= _expires_at:
+            return None
+        if now >= _expires_at - GOOGLE_CERTS_REFRESH_MARGIN and not _refreshing:
+            _refreshing = True
+            threading.Thread(target=_background_refresh, daemon=True).start()
+        return _certs
+
+def get_certs(force: bool = False) -> Dict[str, str]:
+    """Current signing certificates (key id -> PEM), fetching only when needed"""
+    certs = _cached(time.monotonic(), force)
+    if certs is not None:
+        metrics.inc("google_certs_cache_hits")
+        return certs
+    with _fetch_lock:
+        # Another request may have fetched while we waited
+        now = time.monotonic()
+        certs = _cached(now, force)
+        if certs is not None:
+            return certs
+        try:
+            _fetch()
+        except Exception:
+            with _lock:
+                stale, expires_at = _certs, _expires_at
+            if stale is not None and now < expires_at + GOOGLE_CERTS_MAX_STALE:
+                metrics.inc("google_certs_stale_served")
+                return stale
+            raise
+    with _lock:
+        return _certs
+
+def _key_id(token: str) -> Optional[str]:
+    try:
+        header = token.split(".", 1)[0]
+        return json.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4))).get("kid")
+    except (ValueError, AttributeError):
+        return None
+
+def verify_google_id_token(token: str, audience: Optional[str]) -> dict:
+    """
+    Drop-in for id_token.verify_oauth2_token using the cached certs. A token
+    signed with a key we have not seen yet triggers one early refresh, since
+    Google publishes rotated keys before signing with them. Raises ValueError.
+    """
+    certs = get_certs()
+    kid = _key_id(token)
+    if kid and kid not in certs:
+        certs = get_certs(force=True)
+    idinfo = google_jwt.decode(token, certs=certs, audience=audience)
+    if idinfo.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer. 'iss' should be one of {GOOGLE_ISSUERS}")
+    return idinfo
@@ -0,0 +1,122 @@
+import os
+import re
+from typing import Dict, Iterable, List, Optional
+
+# Vocabulary file: one canonical term per line, optionally followed by synonyms
+# that are reported as the canonical term, e.g. "hypertension: high blood pressure, htn".
+# Blank lines and lines starting with '#' are ignored.
+VOCAB_PATH = os.getenv("RAG_VOCAB_PATH", os.path.join(os.path.dirname(__file__), "medical_vocab.txt"))
+
+# Terms this short are abbreviations ("mi", "bp", "sob") and must match a whole word
+ABBREVIATION_MAX_LEN = 3
+
+# Words that look medical by their ending
+MEDICAL_SUFFIXES = ['itis', 'osis', 'emia', 'pathy', 'ology', 'ectomy']
+
+def load_vocabulary(path: str) -> Dict[str, str]:
+    """Parse a vocabulary file into a {surface form: canonical term} map"""
+    vocab: Dict[str, str] = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            canonical, _, synonyms = line.partition(':')
+            canonical = canonical.strip().lower()
+            vocab[canonical] = canonical
+            for synonym in synonyms.split(','):
+                synonym = synonym.strip().lower()
+                if synonym:
+                    vocab.setdefault(synonym, canonical)
+    return vocab
+
+def _trie_pattern(terms: Iterable[str]) -> str:
+    """
+    Build a regex that matches any of the terms, factored as a character trie.
+
+    A flat "a|b|c" alternation is retried term by term at every position; the
+    trie form fails after a character or two, so scan cost depends on the text
+    length rather than the vocabulary size. Terminal nodes become greedy
+    optional groups, so the longest term at a position wins.
+    """
+    trie: dict = {}
+    for term in terms:
+        node = trie
+        for ch in term:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def render(node: dict) -> str:
+        terminal = '' in node
+        branches = [re.escape(ch) + render(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if terminal:
+            body = '(?:' + body + ')?'
+        return body
+
+    return render(trie)
+
+def _continues_word(text: str, pos: int) -> bool:
+    return pos < len(text) and (text[pos].isalnum() or text[pos] == '_')
+
+class KeywordMatcher:
+    """
+    Single-pass medical keyword extractor compiled once from a vocabulary.
+
+    Terms match at the start of a word (so "pain" still finds "painful") and
+    abbreviations only as whole words. A matched term also reports the
+    vocabulary terms it contains, e.g. "chest pain" yields "pain" too, which keeps
+    the multi-term hits the old substring scan gave.
+    """
+
+    def __init__(self, vocab: Dict[str, str], suffixes: List[str] = MEDICAL_SUFFIXES):
+        self.vocab = vocab
+        self.term_re = re.compile(r'\b' + _trie_pattern(vocab)) if vocab else None
+        self.suffix_re = re.compile(r'\b\w*(?:' + '|'.join(map(re.escape, suffixes)) + r')\b')
+        self.contained = {surface: self._contained_terms(surface) for surface in vocab}
+
+    def _contained_terms(self, surface: str) -> List[str]:
+        found = {self.vocab[surface]}
+        for start in (m.start() for m in re.finditer(r'\b\w', surface)):
+            # Every vocabulary term that is a prefix of the surface at this word start
+            for end in range(start + 1, len(surface) + 1):
+                canonical = self.vocab.get(surface[start:end])
+                if not canonical or (start, end) == (0, len(surface)):
+                    continue
+                if end - start <= ABBREVIATION_MAX_LEN and _continues_word(surface, end):
+                    continue
+                found.add(canonical)
+        return sorted(found)
+
+    def extract(self, text: str) -> List[str]:
+        text_lower = text.lower()
+        found = set()
+        if self.term_re is not None:
+            for m in self.term_re.finditer(text_lower):
+                surface = m.group()
+                if len(surface) <= ABBREVIATION_MAX_LEN and _continues_word(text_lower, m.end()):
+                    continue
+                found.update(self.contained[surface])
+        found.update(self.suffix_re.findall(text_lower))
+        return list(found)
+
+    def extract_batch(self, texts: Iterable[str]) -> List[List[str]]:
+        return [self.extract(text) for text in texts]
+
+_matcher: Optional[KeywordMatcher] = None
+
+def get_matcher() -> KeywordMatcher:
+    global _matcher
+    if _matcher is None:
+        _matcher = KeywordMatcher(load_vocabulary(VOCAB_PATH))
+    return _matcher
+
+def set_vocabulary(vocab: Dict[str, str]):
+    """Swap in a different vocabulary, e.g. one loaded from a larger terminology export"""
+    global _matcher
+    _matcher = KeywordMatcher(vocab)
+
+# Compile at import so the first request does not pay for it
+get_matcher()
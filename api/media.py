@@ -0,0 +1,223 @@
+import base64
+import hashlib
+import io
+import mimetypes
+import os
+import shutil
+import time
+import uuid
+from typing import Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+import aiofiles
+import requests
+from fastapi import HTTPException, UploadFile
+
+from cache import LRUCache
+import metrics
+
+try:
+    from PIL import Image  # optional: enables IMAGE_MAX_DIM downscaling
+except ImportError:
+    Image = None
+
+STORAGE_DIR = "storage"
+# Content-addressed upload blobs, named by SHA-256. Kept outside STORAGE_DIR so
+# they are not served directly; each upload in storage/ is a hard link to its
+# blob, so the blob's link count is the number of files referencing it.
+BLOB_DIR = os.getenv("BLOB_DIR", "blobs")
+# Unlinked blobs younger than this are left alone: another worker may be about to link them
+BLOB_GC_GRACE = float(os.getenv("BLOB_GC_GRACE", "3600"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_MB", "50")) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# An oversized body up to this size is read and discarded before the 413 goes out, so
+# the client gets the response instead of a connection reset; larger ones are cut off
+UPLOAD_DRAIN_MAX_BYTES = int(os.getenv("UPLOAD_DRAIN_MB", "100")) * 1024 * 1024
+# Byte budget for cached base64 data URLs of images sent to the model
+IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", "64"))
+# Longest side, in pixels, images are downscaled to before sending; 0 keeps originals
+IMAGE_MAX_DIM = int(os.getenv("IMAGE_MAX_DIM", "0"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+_data_urls = LRUCache(IMAGE_CACHE_MB * 1024 * 1024)
+
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+def sniff_mime(data: bytes, name: str = "") -> str:
+    """Image mime type from magic bytes, falling back to the file name"""
+    for signature, mime in _SIGNATURES:
+        if data.startswith(signature):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return mimetypes.guess_type(name)[0] or "image/jpeg"
+
+def local_storage_path(url: str) -> Optional[str]:
+    """Map a /storage/... URL (relative or absolute) to the file this process wrote, if any"""
+    path = unquote(urlparse(url).path)
+    if not path.startswith(f"/{STORAGE_DIR}/"):
+        return None
+    root = os.path.realpath(STORAGE_DIR)
+    full = os.path.realpath(os.path.join(root, path[len(STORAGE_DIR) + 2:]))
+    # Refuse anything that resolves outside storage/ (e.g. "..", symlinks)
+    if not full.startswith(root + os.sep) or not os.path.isfile(full):
+        return None
+    return full
+
+def _downscale(data: bytes, mime: str) -> Tuple[bytes, str]:
+    if Image is None or not IMAGE_MAX_DIM:
+        return data, mime
+    with Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= IMAGE_MAX_DIM:
+            return data, mime
+        img.thumbnail((IMAGE_MAX_DIM, IMAGE_MAX_DIM))
+        out = io.BytesIO()
+        if img.mode in ("RGBA", "LA", "P"):
+            img.save(out, format="PNG", optimize=True)
+            return out.getvalue(), "image/png"
+        img.convert("RGB").save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY)
+        return out.getvalue(), "image/jpeg"
+
+def _encode(data: bytes, name: str) -> str:
+    data, mime = _downscale(data, sniff_mime(data, name))
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def image_data_url(url: str) -> str:
+    """
+    Base64 data URL for an image referenced by a chat turn. Uploaded files are
+    read from local storage and their encoded payload is cached, keyed by file
+    identity, so repeated turns on the same image skip the read and re-encode.
+    """
+    path = local_storage_path(url)
+    if path is None:
+        r = requests.get(url, timeout=10)
+        r.raise_for_status()
+        return _encode(r.content, urlparse(url).path)
+
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size, IMAGE_MAX_DIM)
+    data_url = _data_urls.get(key)
+    if data_url is not None:
+        metrics.inc("image_cache_hits")
+        return data_url
+    metrics.inc("image_cache_misses")
+    with open(path, "rb") as f:
+        data_url = _encode(f.read(), path)
+    _data_urls.put(key, data_url, weight=len(data_url))
+    return data_url
+
+def _upload_too_large() -> HTTPException:
+    return HTTPException(413, f"Upload exceeds {UPLOAD_MAX_BYTES // (1024 * 1024)} MB limit")
+
+class UploadLimitMiddleware:
+    """
+    Reject oversized request bodies on the given paths before they are parsed:
+    from Content-Length (discarding the body rather than spooling it), or as soon
+    as a chunked body passes the limit. Multipart parsing would otherwise spool
+    the whole body before /upload runs.
+    """
+
+    def __init__(self, app, paths=("/upload",), max_bytes: int = UPLOAD_MAX_BYTES):
+        self.app = app
+        self.paths = set(paths)
+        # Allow for multipart boundaries and headers around the file itself
+        self.max_bytes = max_bytes + 64 * 1024
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            drained = 0
+            while drained < UPLOAD_DRAIN_MAX_BYTES:
+                message = await receive()
+                if message["type"] != "http.request":
+                    return  # client went away
+                drained += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    break
+            await send({"type": "http.response.start", "status": 413,
+                        "headers": [(b"content-type", b"application/json"), (b"connection", b"close")]})
+            await send({"type": "http.response.body", "body": b'{"detail":"Upload too large"}'})
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI re-raises HTTPExceptions from body parsing as-is
+                    raise _upload_too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+def _link(blob: str, path: str):
+    try:
+        os.link(blob, path)
+    except OSError:
+        # Filesystems without hard links (or across devices) get a plain copy
+        shutil.copyfile(blob, path)
+
+async def save_upload(file: UploadFile, path: str) -> Tuple[int, str]:
+    """
+    Stream an upload to disk in fixed-size chunks, hashing as it goes, and link
+    it into place at `path`. Identical content is stored once. Returns (size, sha256).
+    """
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    tmp = os.path.join(BLOB_DIR, f".upload-{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise _upload_too_large()
+                digest.update(chunk)
+                await out.write(chunk)
+        sha256 = digest.hexdigest()
+        blob = os.path.join(BLOB_DIR, sha256)
+        if os.path.exists(blob):
+            # Restart the blob's grace period so a concurrent orphan sweep keeps it
+            os.utime(blob)
+            os.remove(tmp)
+            metrics.inc("upload_dedup_hits")
+            metrics.inc("upload_dedup_bytes_saved", size)
+        else:
+            os.replace(tmp, blob)
+        _link(blob, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    metrics.observe("upload_bytes", size)
+    return size, sha256
+
+def collect_orphan_blobs(grace: float = BLOB_GC_GRACE) -> int:
+    """
+    Delete blobs whose last upload link in storage/ has been removed (link
+    count 1), unless modified within the last `grace` seconds. save_upload()
+    moves a blob into place before linking it, and refreshes an existing
+    blob's mtime before reusing it, so fresh unlinked blobs may be in use.
+    """
+    removed = 0
+    if not os.path.isdir(BLOB_DIR):
+        return 0
+    cutoff = time.time() - grace
+    for entry in os.scandir(BLOB_DIR):
+        if not entry.is_file() or entry.name.startswith("."):
+            continue
+        st = entry.stat()
+        if st.st_nlink == 1 and st.st_mtime < cutoff:
+            os.remove(entry.path)
+            removed += 1
+    return removed
@@ -0,0 +1,41 @@
+import threading
+from collections import defaultdict
+from typing import Dict
+
+# In-process counters, gauges and summaries, exposed as JSON on /metrics.
+# Each worker keeps its own numbers; scrape every worker or aggregate downstream.
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_summaries: Dict[str, list] = {}  # name -> [count, sum, max]
+
+def inc(name: str, value: float = 1):
+    with _lock:
+        _counters[name] += value
+
+def set_gauge(name: str, value: float):
+    with _lock:
+        _gauges[name] = value
+
+def add_gauge(name: str, delta: float):
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + delta
+
+def observe(name: str, value: float):
+    """Record one observation (a latency, a size) into a count/sum/max summary"""
+    with _lock:
+        s = _summaries.setdefault(name, [0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += value
+        s[2] = max(s[2], value)
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "summaries": {
+                name: {"count": c, "sum": total, "avg": total / c if c else 0.0, "max": mx}
+                for name, (c, total, mx) in _summaries.items()
+            },
+        }
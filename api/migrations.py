@@ -0,0 +1,84 @@
+"""
+Lightweight schema migrations, applied at startup by init_db().
+
+create_all() only creates missing tables, so changes to tables that already
+exist (new indexes, new columns) are listed here as numbered steps. Applied
+versions are recorded in schema_migrations; each pending step runs once, in
+order, in its own transaction, holding a lock (an advisory lock on Postgres,
+the write lock on SQLite) so that workers starting together apply it once.
+Steps should still be idempotent (IF NOT EXISTS) for other databases.
+"""
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+
+from models import Base
+
+def _create_indexes(*names: str):
+    def step(conn: Connection):
+        indexes = {ix.name: ix for table in Base.metadata.tables.values() for ix in table.indexes}
+        for name in names:
+            conn.execute(CreateIndex(indexes[name], if_not_exists=True))
+    return step
+
+def _add_columns(table: str, *names: str):
+    def step(conn: Connection):
+        existing = {c["name"] for c in inspect(conn).get_columns(table)}
+        for name in names:
+            if name in existing:
+                continue
+            column = Base.metadata.tables[table].c[name]
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}"))
+    return step
+
+MIGRATIONS = [
+    ("0001_hot_path_indexes", _create_indexes(
+        "ix_doctors_google_id",
+        "ix_patients_doctor_created",
+        "ix_chats_doctor_general_created",
+        "ix_chats_patient_doctor_created",
+        "ix_messages_chat_created",
+        "ix_messages_patient_doctor_created",
+    )),
+    ("0002_patient_media_index", _create_indexes("ix_messages_patient_media")),
+    ("0003_message_token_count", _add_columns("messages", "token_count")),
+    ("0004_chat_summary", _add_columns("chats", "summary", "summarized_until")),
+    ("0005_message_token_counter", _add_columns("messages", "token_counter")),
+]
+
+def _applied(conn: Connection) -> set:
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+def run_migrations(engine: Engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR PRIMARY KEY, applied_at TIMESTAMP)"
+        ))
+        applied = _applied(conn)
+    for version, step in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    # Serialise concurrent workers; released at commit
+                    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('medra_schema_migrations'))"))
+                elif conn.dialect.name == "sqlite":
+                    # pysqlite doesn't open a transaction before DDL; take the write lock up front
+                    # so workers don't race on ALTER TABLE
+                    conn.exec_driver_sql("BEGIN IMMEDIATE")
+                if version in _applied(conn):
+                    continue
+                step(conn)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, applied_at) VALUES (:v, :t)"),
+                    {"v": version, "t": datetime.utcnow()},
+                )
+            print(f"Applied migration {version}")
+        except IntegrityError:
+            # Another worker recorded the same version first
+            pass
@@ -1,15 +1,40 @@
-from sqlalchemy import Column, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, String, Text, Integer, DateTime, ForeignKey, Index
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.types import BLOB
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime
 import os, uuid
 
 Base = declarative_base()
 DB_URL = os.getenv("DB_URL", "sqlite:///./medra.db")
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+# Connections kept open per engine, and extra ones allowed under burst (each worker
+# has a sync and an async engine)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+def async_url(url: str) -> str:
+    """The async driver's URL for a sync DB_URL: aiosqlite for SQLite, asyncpg for Postgres"""
+    scheme, sep, rest = url.partition("://")
+    if scheme.startswith("sqlite"):
+        return "sqlite+aiosqlite" + sep + rest
+    if scheme.startswith("postgres"):
+        return "postgresql+asyncpg" + sep + rest
+    return url
+
+# The async engine serves the CRUD endpoints on the event loop; the sync one is
+# for threadpool work (/stream prompt assembly, write-behind, summaries, migrations)
+ASYNC_DB_URL = os.getenv("ASYNC_DB_URL") or async_url(DB_URL)
+_pool = dict(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+_sqlite = DB_URL.startswith("sqlite")
+engine = create_engine(DB_URL, connect_args={"check_same_thread": False} if _sqlite else {}, **_pool)
+# aiosqlite would default to no pooling at all; use the same bounded pool as Postgres
+async_engine = create_async_engine(ASYNC_DB_URL, poolclass=AsyncAdaptedQueuePool, **_pool)
 SessionLocal = sessionmaker(engine, expire_on_commit=False)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 
 def gen_id(): return str(uuid.uuid4())
 
@@ -27,6 +52,10 @@ class Doctor(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     last_login = Column(DateTime, nullable=True)
 
+    __table_args__ = (
+        Index("ix_doctors_google_id", "google_id"),  # /auth/google lookup
+    )
+
 class Patient(Base):
     __tablename__ = "patients"
     id = Column(String, primary_key=True, default=gen_id)
@@ -36,6 +65,10 @@ class Patient(Base):
     notes = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_patients_doctor_created", "doctor_id", "created_at"),  # /patients
+    )
+
 class Chat(Base):
     __tablename__ = "chats"
     id = Column(String, primary_key=True, default=gen_id)
@@ -44,8 +77,15 @@ class Chat(Base):
     patient_name = Column(String, nullable=True)  # Store patient name for easy access
     title = Column(String)
     is_general = Column(String, default="false")  # "true" for general chats, "false" for patient-specific
+    summary = Column(Text, nullable=True)  # rolling summary of older turns, see summaries.py
+    summarized_until = Column(DateTime, nullable=True)  # created_at of the last message folded into summary
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_chats_doctor_general_created", "doctor_id", "is_general", "created_at"),  # /chats, /chats/general
+        Index("ix_chats_patient_doctor_created", "patient_id", "doctor_id", "created_at"),  # patient profile, /chats?patient_id
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(String, primary_key=True, default=gen_id)
@@ -58,7 +98,20 @@ class Message(Base):
     media_url = Column(String)  # local /storage path
     media_type = Column(String, nullable=True)  # 'image', 'audio', etc.
     file_name = Column(String, nullable=True)  # original filename
+    token_count = Column(Integer, nullable=True)  # cached prompt token count of text, see prompt.py
+    token_counter = Column(String, nullable=True)  # tokenizer that produced token_count
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_messages_chat_created", "chat_id", "created_at"),  # /messages, /stream history
+        Index("ix_messages_patient_doctor_created", "patient_id", "doctor_id", "created_at"),  # patient profile
+        # Attachments on the patient profile; partial, so it only holds messages with files
+        Index("ix_messages_patient_media", "patient_id", "doctor_id", "created_at",
+              sqlite_where=media_url.isnot(None), postgresql_where=media_url.isnot(None)),
+    )
+
 def init_db():
-    Base.metadata.create_all(engine)
\ No newline at end of file
+    Base.metadata.create_all(engine)
+    # create_all never alters existing tables; schema changes to those go through migrations
+    from migrations import run_migrations
+    run_migrations(engine)
\ No newline at end of file
@@ -0,0 +1,56 @@
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, Response
+from sqlalchemy import Select, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Keyset pagination on (created_at, id). The cursor is opaque to clients: it
+# encodes the last row of the page, and the next page continues strictly past
+# it, so each page costs one index range scan no matter how deep it is.
+MAX_PAGE_SIZE = 200
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(created_at: datetime, row_id: str) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, row_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), row_id
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(400, "Invalid cursor")
+
+def apply_keyset(query, sort_column, id_column, cursor: Optional[str] = None, newest_first: bool = True):
+    """Filter `query` to rows strictly past `cursor` and order it by (sort_column, id_column)"""
+    if cursor:
+        sort_value, row_id = decode_cursor(cursor)
+        if newest_first:
+            query = query.filter(or_(sort_column < sort_value,
+                                     and_(sort_column == sort_value, id_column < row_id)))
+        else:
+            query = query.filter(or_(sort_column > sort_value,
+                                     and_(sort_column == sort_value, id_column > row_id)))
+    if newest_first:
+        return query.order_by(sort_column.desc(), id_column.desc())
+    return query.order_by(sort_column.asc(), id_column.asc())
+
+async def paginate(db: AsyncSession, query: Select, model, limit: int, cursor: Optional[str] = None,
+                   newest_first: bool = True) -> Tuple[List, Optional[str]]:
+    """
+    Return one page of `query` ordered by (created_at, id) and the cursor for
+    the next page, or None when this is the last one.
+    """
+    query = apply_keyset(query, model.created_at, model.id, cursor, newest_first)
+    # One extra row tells us whether another page exists
+    rows = (await db.scalars(query.limit(limit + 1))).all()
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1].created_at, page[-1].id) if len(rows) > limit else None
+    return page, next_cursor
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
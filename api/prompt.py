@@ -0,0 +1,157 @@
+"""
+Token-budgeted prompt assembly for /stream.
+
+The upstream context window, less the reply's max_tokens, is filled by priority:
+the system prompt, patient notes and the current turn first, then the chat's
+rolling summary, then as much of the newest history as fits, then RAG
+citations. Token counts of stored messages are cached on Message.token_count,
+tagged with the tokenizer that produced them, so each turn only counts new
+text and a change of PROMPT_TOKENIZER recounts.
+
+tiktoken downloads an encoding on first use. Deployments fetch it at build
+time into TIKTOKEN_CACHE_DIR (`python prompt.py`), so workers load it offline.
+Without it, counts fall back to a deliberately high estimate.
+"""
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+# Where the encoding is fetched to at build time and read from at run time
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tiktoken"))
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "8192"))
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "cl100k_base")
+# Most recent messages considered for history; the budget usually stops sooner
+PROMPT_HISTORY_MESSAGES = int(os.getenv("PROMPT_HISTORY_MESSAGES", "50"))
+# Longest any one RAG citation may be
+PROMPT_RAG_ENTRY_TOKENS = int(os.getenv("PROMPT_RAG_ENTRY_TOKENS", "120"))
+# Rough cost of an attached image for vision models
+PROMPT_IMAGE_TOKENS = int(os.getenv("PROMPT_IMAGE_TOKENS", "765"))
+# Chat-format framing per message (role, separators) and for the reply primer
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+# UTF-8 bytes per token assumed when estimating. English BPE averages about 4,
+# clinical terms and non-Latin scripts fewer, so 3 leaves a margin for both.
+ESTIMATE_BYTES_PER_TOKEN = 3
+
+_encoding = None
+if tiktoken is not None:
+    try:
+        _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER)
+    except Exception as e:
+        print(f"Tokenizer {PROMPT_TOKENIZER} unavailable, estimating token counts: {e}")
+# Recorded next to cached counts, so counts from another tokenizer are not reused
+TOKEN_COUNTER = PROMPT_TOKENIZER if _encoding is not None else "estimate"
+
+def count_tokens(text: Optional[str]) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return -(-len(text.encode("utf-8")) // ESTIMATE_BYTES_PER_TOKEN)
+
+def truncate_tokens(text: str, limit: int) -> str:
+    """Leading part of `text` that fits in `limit` tokens"""
+    if limit <= 0:
+        return ""
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= limit else _encoding.decode(tokens[:limit])
+    return text.encode("utf-8")[:limit * ESTIMATE_BYTES_PER_TOKEN].decode("utf-8", errors="ignore")
+
+def message_tokens(message) -> int:
+    """Token count of a stored Message, cached on the row (the caller commits)"""
+    if message.token_count is None or message.token_counter != TOKEN_COUNTER:
+        message.token_count = count_tokens(message.text)
+        message.token_counter = TOKEN_COUNTER
+    return message.token_count
+
+def _fit(text: str, used: int, budget: int, truncated_metric: str) -> str:
+    if used + count_tokens(text) > budget:
+        metrics.inc(truncated_metric)
+        return truncate_tokens(text, budget - used)
+    return text
+
+def build_prompt(system: str, notes: Optional[str], history: list, rag: List[dict],
+                 prompt: str, max_tokens: int, image: bool = False,
+                 summary: Optional[str] = None) -> Tuple[str, str, List[Dict], Dict]:
+    """
+    Returns (system content, RAG context to append to it, history as chat
+    messages oldest first, token breakdown). `history` holds Message rows newest
+    first, without the current turn and without the turns already folded into `summary`.
+    """
+    budget = PROMPT_CONTEXT_TOKENS - (max_tokens or 0) - REPLY_OVERHEAD
+    breakdown = {
+        "budget": budget,
+        "reserved_output": max_tokens or 0,
+        "system": count_tokens(system) + MESSAGE_OVERHEAD,
+        "prompt": count_tokens(prompt) + MESSAGE_OVERHEAD,
+        "image": PROMPT_IMAGE_TOKENS if image else 0,
+    }
+    used = breakdown["system"] + breakdown["prompt"] + breakdown["image"]
+
+    # Patient notes, then the summary of earlier turns, cut only if they alone overflow
+    notes_part = _fit(f"\nPatient notes: {notes}", used, budget, "prompt_notes_truncated") if notes else ""
+    breakdown["notes"] = count_tokens(notes_part)
+    used += breakdown["notes"]
+    summary_part = ""
+    if summary:
+        summary_part = _fit(f"\n\nSummary of the earlier conversation:\n{summary}", used, budget,
+                            "prompt_summary_truncated")
+    breakdown["summary"] = count_tokens(summary_part)
+    used += breakdown["summary"]
+
+    # Newest history first; stop at the first turn that does not fit so the
+    # model sees a contiguous tail of the conversation
+    kept = []
+    for message in history:
+        if not message.text:
+            continue
+        cost = message_tokens(message) + MESSAGE_OVERHEAD
+        if used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    breakdown["history"] = sum(message_tokens(m) + MESSAGE_OVERHEAD for m in kept)
+    breakdown["history_messages"] = len(kept)
+    dropped = sum(1 for m in history if m.text) - len(kept)
+    if dropped:
+        metrics.inc("prompt_history_dropped", dropped)
+
+    # RAG citations, best first, while they fit
+    citations = []
+    rag_header = "\n\nRelevant context from previous conversations:\n"
+    rag_used = count_tokens(rag_header)
+    for entry in rag:
+        line = f"- {truncate_tokens(entry['text'], PROMPT_RAG_ENTRY_TOKENS)}"
+        cost = count_tokens(line) + 1
+        if used + rag_used + cost > budget:
+            break
+        citations.append(line)
+        rag_used += cost
+    rag_part = rag_header + "\n".join(citations) if citations else ""
+    breakdown["rag"] = rag_used if citations else 0
+    breakdown["rag_entries"] = len(citations)
+    used += breakdown["rag"]
+
+    breakdown["total"] = used
+    metrics.observe("prompt_tokens_total", used)
+    for part in ("system", "notes", "summary", "history", "rag", "prompt"):
+        metrics.observe(f"prompt_tokens_{part}", breakdown[part])
+
+    messages = [{"role": m.role, "content": m.text} for m in reversed(kept)]
+    return system + notes_part + summary_part, rag_part, messages, breakdown
+
+if __name__ == "__main__":
+    # Build step: fetch the encoding into TIKTOKEN_CACHE_DIR, failing the build if it can't
+    if _encoding is None:
+        sys.exit(f"Tokenizer {PROMPT_TOKENIZER} could not be loaded")
+    print(f"Tokenizer {PROMPT_TOKENIZER} cached in {os.environ['TIKTOKEN_CACHE_DIR']}")
@@ -1,141 +1,432 @@
+import bisect
+import heapq
 import json
+import math
 import os
-from typing import List, Dict, Optional
+import sqlite3
+import threading
+from collections import deque
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
-import re
+from cache import LRUCache
+from keywords import get_matcher
+import vectors
 
-# Simple in-memory storage for conversation context
-# In production, this would be a proper vector database
+# Conversation context lives in a sidecar SQLite database with an FTS5 index.
+# Saving a message is a single-row append and retrieval is a BM25-ranked index
+# lookup, so per-turn cost stays flat as a doctor's history grows. WAL mode lets
+# every gunicorn worker read and append to the same file concurrently.
+RAG_DB_PATH = os.getenv("RAG_DB_PATH", "rag.db")
+MAX_MESSAGES_PER_DOCTOR = int(os.getenv("RAG_MAX_MESSAGES_PER_DOCTOR", "1000"))
+
+# Resident per-doctor inverted indexes; the budget is counted in postings entries
+RESIDENT_INDEX = os.getenv("RAG_RESIDENT_INDEX", "1") == "1"
+INDEX_MAX_POSTINGS = int(os.getenv("RAG_INDEX_MAX_POSTINGS", "2000000"))
+
+# "keyword" (default), "vector" or "hybrid"; see vectors.py for the embedding side
+RAG_MODE = os.getenv("RAG_MODE", "keyword")
+# Weight of the vector score in hybrid mode; the rest goes to the keyword score
+HYBRID_ALPHA = float(os.getenv("RAG_HYBRID_ALPHA", "0.5"))
+VECTOR_MIN_SCORE = float(os.getenv("RAG_VECTOR_MIN_SCORE", "0.1"))
+
+# Legacy whole-file store, imported into RAG_DB_PATH once and then renamed
 CONVERSATION_STORE = "conversation_store.json"
 
-def save_conversation_context(doctor_id: str, patient_id: Optional[str], chat_id: str, 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rag_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doctor_id TEXT NOT NULL,
+    patient_id TEXT,
+    patient_name TEXT,
+    chat_id TEXT,
+    role TEXT,
+    text TEXT NOT NULL,
+    keywords TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_rag_messages_doctor ON rag_messages (doctor_id, id);
+-- Keywords are stored as one token each (spaces -> underscores) so that a
+-- multi-word term like "chest pain" can only match as a whole.
+CREATE VIRTUAL TABLE IF NOT EXISTS rag_fts USING fts5(
+    doctor_id, patient_id, keywords,
+    content='rag_messages', content_rowid='id',
+    tokenize="unicode61 tokenchars '_-'"
+);
+CREATE TRIGGER IF NOT EXISTS rag_messages_ai AFTER INSERT ON rag_messages BEGIN
+    INSERT INTO rag_fts(rowid, doctor_id, patient_id, keywords)
+    VALUES (new.id, new.doctor_id, new.patient_id, new.keywords);
+END;
+CREATE TRIGGER IF NOT EXISTS rag_messages_ad AFTER DELETE ON rag_messages BEGIN
+    INSERT INTO rag_fts(rag_fts, rowid, doctor_id, patient_id, keywords)
+    VALUES ('delete', old.id, old.doctor_id, old.patient_id, old.keywords);
+END;
+CREATE TABLE IF NOT EXISTS rag_vectors (
+    message_id INTEGER PRIMARY KEY,
+    dim INTEGER NOT NULL,
+    embedding BLOB NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS rag_messages_ad_vectors AFTER DELETE ON rag_messages BEGIN
+    DELETE FROM rag_vectors WHERE message_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS rag_messages_au AFTER UPDATE ON rag_messages BEGIN
+    INSERT INTO rag_fts(rag_fts, rowid, doctor_id, patient_id, keywords)
+    VALUES ('delete', old.id, old.doctor_id, old.patient_id, old.keywords);
+    INSERT INTO rag_fts(rowid, doctor_id, patient_id, keywords)
+    VALUES (new.id, new.doctor_id, new.patient_id, new.keywords);
+END;
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(RAG_DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Return this thread's connection to the RAG store, creating the schema on first use"""
+    global _initialized
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                conn.executescript(SCHEMA)
+                migrate_json_store(conn)
+                _initialized = True
+    return conn
+
+def _encode_keywords(keywords: List[str]) -> str:
+    return " ".join(k.replace(" ", "_") for k in keywords)
+
+def _quote(token: str) -> str:
+    return '"' + token.replace('"', '""') + '"'
+
+class DoctorIndex:
+    """
+    Resident keyword -> message id postings for one doctor, split by patient_id.
+
+    Postings lists only ever grow at the tail (SQLite ids are monotonic), so ids
+    that fell out of the per-doctor cap form a prefix that is skipped with a
+    bisect and compacted away once it makes up half the index.
+    """
+
+    def __init__(self, doctor_id: str):
+        self.doctor_id = doctor_id
+        self.postings: Dict[str, Dict[Optional[str], List[int]]] = {}
+        self.live: deque = deque()  # (message_id, keyword count) for rows still under the cap
+        self.min_id = 0
+        self.last_id = 0
+        self.size = 0  # postings entries including stale ones, used as the LRU weight
+        self.stale = 0
+        self.lock = threading.Lock()
+
+    def add(self, message_id: int, patient_id: Optional[str], tokens: List[str]):
+        for token in tokens:
+            self.postings.setdefault(token, {}).setdefault(patient_id, []).append(message_id)
+        self.live.append((message_id, len(tokens)))
+        self.size += len(tokens)
+        self.last_id = message_id
+        while len(self.live) > MAX_MESSAGES_PER_DOCTOR:
+            old_id, count = self.live.popleft()
+            self.min_id = old_id + 1
+            self.stale += count
+        if self.stale > 1024 and self.stale * 2 > self.size:
+            self._compact()
+
+    def _compact(self):
+        for token in list(self.postings):
+            partitions = self.postings[token]
+            for patient_id in list(partitions):
+                ids = partitions[patient_id]
+                live = ids[bisect.bisect_left(ids, self.min_id):]
+                if live:
+                    partitions[patient_id] = live
+                else:
+                    del partitions[patient_id]
+            if not partitions:
+                del self.postings[token]
+        self.size -= self.stale
+        self.stale = 0
+
+    def catch_up(self, conn: sqlite3.Connection):
+        """Apply rows appended since the last sync, including other workers' writes"""
+        rows = conn.execute(
+            "SELECT id, patient_id, keywords FROM rag_messages WHERE doctor_id = ? AND id > ? ORDER BY id",
+            (self.doctor_id, self.last_id),
+        ).fetchall()
+        for message_id, patient_id, keywords in rows:
+            self.add(message_id, patient_id, keywords.split())
+
+    def search(self, tokens: List[str], patient_id: Optional[str], k: int) -> List[Tuple[float, int]]:
+        """Top-k (score, message_id) by IDF-weighted keyword overlap, newest first on ties"""
+        scores = self.scores(tokens, patient_id)
+        return heapq.nlargest(k, ((score, message_id) for message_id, score in scores.items()))
+
+    def scores(self, tokens: List[str], patient_id: Optional[str]) -> Dict[int, float]:
+        """IDF-weighted keyword overlap per matching message; touches only the query's postings"""
+        n = len(self.live)
+        scores: Dict[int, float] = {}
+        for token in set(tokens):
+            partitions = self.postings.get(token)
+            if not partitions:
+                continue
+            lists = [partitions.get(patient_id, [])] if patient_id else list(partitions.values())
+            starts = [bisect.bisect_left(ids, self.min_id) for ids in lists]
+            df = sum(len(ids) - start for ids, start in zip(lists, starts))
+            if not df:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for ids, start in zip(lists, starts):
+                for message_id in ids[start:]:
+                    scores[message_id] = scores.get(message_id, 0.0) + idf
+        return scores
+
+_indexes = LRUCache(INDEX_MAX_POSTINGS)
+
+def get_doctor_index(doctor_id: str) -> DoctorIndex:
+    """Return the doctor's resident index, building it lazily and syncing new rows"""
+    index = _indexes.get(doctor_id)
+    if index is None:
+        index = DoctorIndex(doctor_id)
+    with index.lock:
+        index.catch_up(get_connection())
+    # Re-put so the LRU weight tracks the index size
+    _indexes.put(doctor_id, index, weight=index.size)
+    return index
+
+def _enforce_cap(conn: sqlite3.Connection, doctor_id: str):
+    # Indexed range delete on (doctor_id, id): drop everything older than the
+    # MAX_MESSAGES_PER_DOCTOR-th newest row
+    conn.execute(
+        """DELETE FROM rag_messages WHERE doctor_id = ? AND id < (
+               SELECT id FROM rag_messages WHERE doctor_id = ?
+               ORDER BY id DESC LIMIT 1 OFFSET ?)""",
+        (doctor_id, doctor_id, MAX_MESSAGES_PER_DOCTOR - 1),
+    )
+
+def migrate_json_store(conn: sqlite3.Connection, path: str = CONVERSATION_STORE) -> int:
+    """
+    One-shot import of the legacy conversation_store.json into the SQLite store.
+    The file is renamed to *.migrated afterwards so the import never repeats.
+    """
+    if not os.path.exists(path):
+        return 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another worker may have finished the import while we waited for the lock
+        if not os.path.exists(path):
+            conn.execute("ROLLBACK")
+            return 0
+        with open(path, 'r') as f:
+            store = json.load(f)
+        imported = 0
+        for doctor_id, doctor_messages in store.items():
+            rows = sorted(doctor_messages.values(), key=lambda m: m.get("timestamp", ""))
+            for m in rows[-MAX_MESSAGES_PER_DOCTOR:]:
+                conn.execute(
+                    """INSERT INTO rag_messages
+                       (doctor_id, patient_id, patient_name, chat_id, role, text, keywords, timestamp)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (doctor_id, m.get("patient_id"), m.get("patient_name"), m.get("chat_id"),
+                     m.get("role"), m.get("text", ""), _encode_keywords(m.get("keywords", [])),
+                     m.get("timestamp") or datetime.utcnow().isoformat()),
+                )
+                imported += 1
+            _enforce_cap(conn, doctor_id)
+        os.replace(path, path + ".migrated")
+        conn.execute("COMMIT")
+        print(f"Migrated {imported} messages from {path} to {RAG_DB_PATH}")
+        return imported
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def save_conversation_context(doctor_id: str, patient_id: Optional[str], chat_id: str,
                             role: str, text: str, patient_name: Optional[str] = None):
     """
     Save conversation message to local context store for RAG retrieval
     """
+    save_conversation_contexts([dict(doctor_id=doctor_id, patient_id=patient_id, chat_id=chat_id,
+                                     role=role, text=text, patient_name=patient_name)])
+
+def save_conversation_contexts(entries: List[Dict]):
+    """
+    Save several messages (save_conversation_context arguments, plus an optional
+    `timestamp`) in one transaction, embedding them in one batch
+    """
+    if not entries:
+        return
     try:
-        # Load existing store
-        if os.path.exists(CONVERSATION_STORE):
-            with open(CONVERSATION_STORE, 'r') as f:
-                store = json.load(f)
-        else:
-            store = {}
-        
-        # Create key for doctor's conversations
-        if doctor_id not in store:
-            store[doctor_id] = {}
-        
-        # Store message with metadata
-        message_id = f"{chat_id}_{datetime.utcnow().isoformat()}"
-        store[doctor_id][message_id] = {
-            "chat_id": chat_id,
-            "patient_id": patient_id,
-            "patient_name": patient_name,
-            "role": role,
-            "text": text,
-            "timestamp": datetime.utcnow().isoformat(),
-            "keywords": extract_medical_keywords(text)
-        }
-        
-        # Keep only last 1000 messages per doctor to prevent unbounded growth
-        messages = list(store[doctor_id].items())
-        if len(messages) > 1000:
-            # Keep most recent 1000
-            store[doctor_id] = dict(messages[-1000:])
-        
-        # Save back to file
-        with open(CONVERSATION_STORE, 'w') as f:
-            json.dump(store, f, indent=2)
-            
+        conn = get_connection()
+        embedder = vectors.get_embedder() if RAG_MODE != "keyword" else None
+        embeddings = embedder.embed([e["text"] for e in entries]) if embedder else None
+        doctor_ids = list(dict.fromkeys(e["doctor_id"] for e in entries))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for i, e in enumerate(entries):
+                timestamp = e.get("timestamp") or datetime.utcnow()
+                cursor = conn.execute(
+                    """INSERT INTO rag_messages
+                       (doctor_id, patient_id, patient_name, chat_id, role, text, keywords, timestamp)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (e["doctor_id"], e.get("patient_id"), e.get("patient_name"), e["chat_id"], e["role"], e["text"],
+                     _encode_keywords(extract_medical_keywords(e["text"])), timestamp.isoformat()),
+                )
+                if embedder:
+                    conn.execute(
+                        "INSERT INTO rag_vectors (message_id, dim, embedding) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, embedder.dim, vectors.to_blob(embeddings[i])),
+                    )
+            # Keep only the most recent messages per doctor to prevent unbounded growth
+            for doctor_id in doctor_ids:
+                _enforce_cap(conn, doctor_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        # Keep a resident index current; doctors without one build it on first retrieval
+        for doctor_id in doctor_ids:
+            if RESIDENT_INDEX and doctor_id in _indexes:
+                get_doctor_index(doctor_id)
+            if embedder and vectors.is_resident(doctor_id):
+                vectors.get_doctor_vectors(doctor_id, conn, MAX_MESSAGES_PER_DOCTOR)
+
     except Exception as e:
         print(f"Error saving conversation context: {e}")
 
 def extract_medical_keywords(text: str) -> List[str]:
     """
-    Extract basic medical keywords from text for simple matching
+    Extract medical keywords from text for simple matching.
+    The matcher is compiled once from the vocabulary file (see keywords.py).
+    """
+    return get_matcher().extract(text)
+
+def extract_medical_keywords_batch(texts: List[str]) -> List[List[str]]:
+    """Extract keywords for many texts with one matcher lookup, for bulk re-indexing"""
+    return get_matcher().extract_batch(texts)
+
+def reindex_keywords(doctor_id: Optional[str] = None, batch_size: int = 500) -> int:
     """
-    # Basic medical terms - in production, use proper medical NLP
-    medical_terms = [
-        'symptom', 'pain', 'fever', 'headache', 'nausea', 'vomiting', 'diarrhea',
-        'blood pressure', 'hypertension', 'diabetes', 'medication', 'treatment',
-        'diagnosis', 'chest pain', 'shortness of breath', 'fatigue', 'dizziness',
-        'heart rate', 'pulse', 'temperature', 'weight', 'appetite', 'sleep',
-        'allergy', 'rash', 'swelling', 'infection', 'inflammation', 'chronic',
-        'acute', 'prescription', 'dosage', 'side effect', 'contraindication'
-    ]
-    
-    text_lower = text.lower()
-    found_terms = []
-    
-    for term in medical_terms:
-        if term in text_lower:
-            found_terms.append(term)
-    
-    # Add any words that look medical (ending in common suffixes)
-    medical_suffixes = ['itis', 'osis', 'emia', 'pathy', 'ology', 'ectomy']
-    words = re.findall(r'\b\w+\b', text_lower)
-    
-    for word in words:
-        if any(word.endswith(suffix) for suffix in medical_suffixes):
-            found_terms.append(word)
-    
-    return list(set(found_terms))  # Remove duplicates
+    Recompute stored keywords with the current vocabulary, e.g. after extending
+    medical_vocab.txt. Runs in batches of rows per transaction; the FTS index is
+    kept in sync by trigger. Other workers' resident indexes refresh on restart.
+    """
+    conn = get_connection()
+    query = "SELECT id, text FROM rag_messages WHERE id > ?"
+    if doctor_id:
+        query += " AND doctor_id = ?"
+    query += " ORDER BY id LIMIT ?"
+    last_id, updated = 0, 0
+    while True:
+        params = [last_id, doctor_id, batch_size] if doctor_id else [last_id, batch_size]
+        rows = conn.execute(query, params).fetchall()
+        if not rows:
+            break
+        keywords = extract_medical_keywords_batch([text for _, text in rows])
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "UPDATE rag_messages SET keywords = ? WHERE id = ?",
+            [(_encode_keywords(kws), message_id) for (message_id, _), kws in zip(rows, keywords)],
+        )
+        conn.execute("COMMIT")
+        last_id = rows[-1][0]
+        updated += len(rows)
+    if doctor_id:
+        _indexes.pop(doctor_id)
+    else:
+        _indexes.clear()
+    return updated
 
 def retrieve_context(query: str, doctor_id: str, patient_id: str | None = None) -> List[Dict]:
     """
     Retrieve relevant conversation context for the query.
-    
+
     Args:
         query: The user's medical question
         doctor_id: Doctor's ID to scope the search
         patient_id: Optional patient ID for personalized context
-        
+
     Returns:
         List of {text, source, timestamp} dictionaries
     """
-    
+
     try:
-        if not os.path.exists(CONVERSATION_STORE):
-            return []
-        
-        with open(CONVERSATION_STORE, 'r') as f:
-            store = json.load(f)
-        
-        if doctor_id not in store:
-            return []
-        
         # Extract keywords from query
         query_keywords = extract_medical_keywords(query)
+        if RAG_MODE in ("vector", "hybrid"):
+            return _retrieve_vector(query, query_keywords, doctor_id, patient_id)
         if not query_keywords:
             return []
-        
-        # Find relevant messages
-        relevant_messages = []
-        doctor_messages = store[doctor_id]
-        
-        for message_id, message_data in doctor_messages.items():
-            # Skip if patient-specific search and doesn't match
-            if patient_id and message_data.get('patient_id') != patient_id:
-                continue
-                
-            # Check for keyword overlap
-            message_keywords = message_data.get('keywords', [])
-            overlap = set(query_keywords) & set(message_keywords)
-            
-            if overlap:
-                score = len(overlap) / len(query_keywords)  # Simple relevance score
-                relevant_messages.append({
-                    "text": message_data['text'][:300] + ("..." if len(message_data['text']) > 300 else ""),
-                    "source": f"Previous conversation with {message_data.get('patient_name', 'patient')}",
-                    "timestamp": message_data['timestamp'],
-                    "score": score,
-                    "role": message_data['role']
-                })
-        
-        # Sort by relevance score and return top 3
-        relevant_messages.sort(key=lambda x: x['score'], reverse=True)
-        return relevant_messages[:3]
-        
+
+        if RESIDENT_INDEX:
+            return _retrieve_resident(query_keywords, doctor_id, patient_id)
+
+        # Doctor (and patient) scoping is part of the FTS match so the index
+        # intersects postings instead of filtering rows afterwards
+        match = f"doctor_id : {_quote(doctor_id)}"
+        if patient_id:
+            match += f" AND patient_id : {_quote(patient_id)}"
+        terms = " OR ".join(_quote(k.replace(" ", "_")) for k in query_keywords)
+        match += f" AND keywords : ({terms})"
+
+        # bm25() is lower-is-better; only the keywords column carries weight
+        rows = get_connection().execute(
+            """SELECT m.text, m.patient_name, m.timestamp, m.role, bm25(rag_fts, 0.0, 0.0, 1.0) AS rank
+               FROM rag_fts JOIN rag_messages m ON m.id = rag_fts.rowid
+               WHERE rag_fts MATCH ?
+               ORDER BY rank, m.id DESC LIMIT 3""",
+            (match,),
+        ).fetchall()
+
+        return [_format_context(text, patient_name, timestamp, role, -rank)
+                for text, patient_name, timestamp, role, rank in rows]
+
     except Exception as e:
         print(f"Error retrieving context: {e}")
         return []
+
+def _retrieve_resident(query_keywords: List[str], doctor_id: str, patient_id: Optional[str]) -> List[Dict]:
+    index = get_doctor_index(doctor_id)
+    return _fetch_context(index.search(_encode_keywords(query_keywords).split(), patient_id, 3))
+
+def _retrieve_vector(query: str, query_keywords: List[str], doctor_id: str, patient_id: Optional[str]) -> List[Dict]:
+    conn = get_connection()
+    doctor = vectors.get_doctor_vectors(doctor_id, conn, MAX_MESSAGES_PER_DOCTOR)
+    keyword_scores = None
+    if RAG_MODE == "hybrid" and query_keywords:
+        keyword_scores = get_doctor_index(doctor_id).scores(_encode_keywords(query_keywords).split(), patient_id)
+    hits = doctor.search(
+        vectors.get_embedder().embed([query])[0], patient_id, 3,
+        keyword_scores=keyword_scores,
+        alpha=HYBRID_ALPHA if keyword_scores else 1.0,
+        min_score=VECTOR_MIN_SCORE,
+    )
+    return _fetch_context(hits)
+
+def _fetch_context(hits: List[Tuple[float, int]]) -> List[Dict]:
+    if not hits:
+        return []
+    placeholders = ",".join("?" * len(hits))
+    rows = get_connection().execute(
+        f"SELECT id, text, patient_name, timestamp, role FROM rag_messages WHERE id IN ({placeholders})",
+        [message_id for _, message_id in hits],
+    ).fetchall()
+    by_id = {row[0]: row[1:] for row in rows}
+    # A row can vanish if another worker's cap delete raced this lookup
+    return [_format_context(*by_id[message_id], score)
+            for score, message_id in hits if message_id in by_id]
+
+def _format_context(text: str, patient_name: Optional[str], timestamp: str, role: str, score: float) -> Dict:
+    return {
+        "text": text[:300] + ("..." if len(text) > 300 else ""),
+        "source": f"Previous conversation with {patient_name or 'patient'}",
+        "timestamp": timestamp,
+        "score": score,
+        "role": role
+    }
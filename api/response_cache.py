@@ -0,0 +1,103 @@
+"""
+Opt-in exact-match cache of model replies for deterministic generations.
+
+The key is a hash of the doctor and of everything that determines the reply:
+endpoint, model, the assembled messages and the sampling parameters. Only
+low-temperature requests are cached, and by default only in general
+(non-patient) chats.
+Entries live in a TTL'd, size-bounded LRU, optionally backed by SQLite so they
+survive restarts and are shared between workers on one host.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from cache import LRUCache
+import metrics
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MB = int(os.getenv("RESPONSE_CACHE_MB", "32"))
+# Requests sampled above this temperature are never cached
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0.2"))
+# "general" caches only non-patient chats; "all" also caches patient chats
+RESPONSE_CACHE_SCOPE = os.getenv("RESPONSE_CACHE_SCOPE", "general")
+# SQLite file for persistence; empty keeps the cache in memory only
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")
+RESPONSE_CACHE_DB_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DB_MAX_ENTRIES", "10000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    tokens TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_response_cache_expires ON response_cache (expires_at);
+"""
+
+_memory = LRUCache(RESPONSE_CACHE_MB * 1024 * 1024)
+_local = threading.local()
+_puts = 0
+
+def _connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(RESPONSE_CACHE_DB, timeout=30, isolation_level=None,
+                                             check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+    return conn
+
+def eligible(chat, temperature: Optional[float]) -> bool:
+    if not RESPONSE_CACHE or temperature is None or temperature > RESPONSE_CACHE_MAX_TEMPERATURE:
+        return False
+    return RESPONSE_CACHE_SCOPE == "all" or chat.is_general == "true"
+
+def key_for(endpoint: str, doctor_id: str, payload: dict) -> str:
+    material = {k: v for k, v in payload.items() if k != "stream"}
+    material["endpoint"] = endpoint
+    material["doctor_id"] = doctor_id
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _weight(tokens: List[str]) -> int:
+    return sum(len(t) for t in tokens) + 64
+
+def get(key: str) -> Optional[List[str]]:
+    """The cached reply as its original stream deltas, or None"""
+    tokens = _memory.get(key)
+    if tokens is None and RESPONSE_CACHE_DB:
+        row = _connection().execute(
+            "SELECT tokens, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+        if row:
+            tokens = json.loads(row[0])
+            _memory.put(key, tokens, weight=_weight(tokens), ttl=row[1] - time.time())
+    metrics.inc("response_cache_hits" if tokens is not None else "response_cache_misses")
+    return tokens
+
+def put(key: str, tokens: List[str]):
+    global _puts
+    _memory.put(key, tokens, weight=_weight(tokens), ttl=RESPONSE_CACHE_TTL)
+    metrics.inc("response_cache_stores")
+    if not RESPONSE_CACHE_DB:
+        return
+    conn = _connection()
+    now = time.time()
+    conn.execute(
+        "INSERT OR REPLACE INTO response_cache (key, tokens, expires_at) VALUES (?, ?, ?)",
+        (key, json.dumps(tokens), now + RESPONSE_CACHE_TTL),
+    )
+    _puts += 1
+    if _puts % 100 == 0:
+        # Drop expired rows, then the soonest-expiring ones past the size bound
+        conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+        conn.execute(
+            "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache "
+            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (RESPONSE_CACHE_DB_MAX_ENTRIES,),
+        )
@@ -0,0 +1,174 @@
+"""
+Routing of generations across model server replicas.
+
+Each stream goes to the healthy replica with the fewest in-flight streams.
+A per-replica circuit breaker opens after ROUTER_BREAKER_FAILURES consecutive
+failures (errors, or a first token slower than ROUTER_SLOW_TTFT) and lets a
+single probe through once ROUTER_BREAKER_COOLDOWN has passed. A request is
+retried on another replica only while nothing has been relayed to the client.
+Only connection errors, timeouts and 5xx responses count against a replica;
+a 4xx is the request's fault and goes straight back to the caller.
+"""
+import asyncio
+import itertools
+import os
+import time
+from typing import AsyncIterator, List, Optional, Set
+
+import httpx
+
+import metrics
+
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", "3"))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", "30"))
+# Seconds to first upstream line that count as a failure for the breaker
+ROUTER_SLOW_TTFT = float(os.getenv("ROUTER_SLOW_TTFT", "20"))
+# Give up on a replica (and try another) if its first line takes longer; 0 waits forever
+ROUTER_FIRST_TOKEN_TIMEOUT = float(os.getenv("ROUTER_FIRST_TOKEN_TIMEOUT", "60"))
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.inflight = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def state(self, now: float) -> str:
+        if self.failures < ROUTER_BREAKER_FAILURES:
+            return "closed"
+        return "open" if now < self.open_until else "half-open"
+
+    def available(self, now: float) -> bool:
+        state = self.state(now)
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+def replica_fault(e: Exception) -> bool:
+    """Whether an upstream error says the replica is unhealthy, rather than the request bad"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, (httpx.TransportError, asyncio.TimeoutError))
+
+class EndpointRouter:
+    """Per-worker; runs on the event loop, so no locking is needed"""
+
+    def __init__(self, urls: List[str]):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._turn = itertools.count()
+
+    def pick(self, exclude: Set[Endpoint]) -> Optional[Endpoint]:
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e not in exclude and e.available(now)]
+        if not candidates:
+            return None
+        least = min(e.inflight for e in candidates)
+        tied = [e for e in candidates if e.inflight == least]
+        # Rotate among equally loaded replicas rather than always taking the first
+        endpoint = tied[next(self._turn) % len(tied)]
+        if endpoint.state(now) == "half-open":
+            endpoint.probing = True
+        return endpoint
+
+    def _success(self, endpoint: Endpoint):
+        if endpoint.failures >= ROUTER_BREAKER_FAILURES:
+            print(f"Model endpoint {endpoint.url} recovered, closing circuit")
+        endpoint.failures = 0
+        endpoint.probing = False
+
+    def _failure(self, endpoint: Endpoint, reason: str):
+        endpoint.failures += 1
+        metrics.inc("router_endpoint_failures")
+        if endpoint.probing or endpoint.failures == ROUTER_BREAKER_FAILURES:
+            endpoint.open_until = time.monotonic() + ROUTER_BREAKER_COOLDOWN
+            metrics.inc("router_breaker_opened")
+            print(f"Model endpoint {endpoint.url} circuit open for {ROUTER_BREAKER_COOLDOWN:.0f}s: {reason}")
+        endpoint.probing = False
+
+    async def stream_lines(self, client: httpx.AsyncClient, payload: dict, headers: dict) -> AsyncIterator[str]:
+        """Upstream SSE lines for one generation, from whichever replica serves it"""
+        tried: Set[Endpoint] = set()
+        last_error: Optional[Exception] = None
+        while True:
+            endpoint = self.pick(tried)
+            if endpoint is None:
+                raise last_error or RuntimeError("No model endpoint available")
+            tried.add(endpoint)
+            endpoint.inflight += 1
+            metrics.set_gauge(f"router_inflight:{endpoint.url}", endpoint.inflight)
+            relayed = False
+            start = time.monotonic()
+            try:
+                async with client.stream("POST", endpoint.url, json=payload, headers=headers) as r:
+                    r.raise_for_status()
+                    lines = r.aiter_lines()
+                    try:
+                        if ROUTER_FIRST_TOKEN_TIMEOUT > 0:
+                            first = await asyncio.wait_for(lines.__anext__(), ROUTER_FIRST_TOKEN_TIMEOUT)
+                        else:
+                            first = await lines.__anext__()
+                    except StopAsyncIteration:
+                        self._success(endpoint)
+                        return
+                    ttft = time.monotonic() - start
+                    metrics.observe("router_ttft_ms", ttft * 1000)
+                    if ttft > ROUTER_SLOW_TTFT:
+                        self._failure(endpoint, f"slow first token ({ttft:.1f}s)")
+                    else:
+                        self._success(endpoint)
+                    relayed = True
+                    yield first
+                    async for line in lines:
+                        yield line
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                # The client went away; not the replica's fault
+                if endpoint.probing:
+                    endpoint.probing = False
+                raise
+            except Exception as e:
+                if not replica_fault(e):
+                    endpoint.probing = False
+                    raise
+                self._failure(endpoint, repr(e))
+                if relayed:
+                    raise
+                last_error = e
+                metrics.inc("router_retries")
+            finally:
+                endpoint.inflight -= 1
+                metrics.set_gauge(f"router_inflight:{endpoint.url}", endpoint.inflight)
+
+    async def post(self, client: httpx.AsyncClient, payload: dict, headers: dict) -> httpx.Response:
+        """A non-streaming call (e.g. a summary), with the same failover and breaker accounting"""
+        tried: Set[Endpoint] = set()
+        last_error: Optional[Exception] = None
+        while True:
+            endpoint = self.pick(tried)
+            if endpoint is None:
+                raise last_error or RuntimeError("No model endpoint available")
+            tried.add(endpoint)
+            endpoint.inflight += 1
+            metrics.set_gauge(f"router_inflight:{endpoint.url}", endpoint.inflight)
+            try:
+                r = await client.post(endpoint.url, json=payload, headers=headers)
+                r.raise_for_status()
+                self._success(endpoint)
+                return r
+            except asyncio.CancelledError:
+                if endpoint.probing:
+                    endpoint.probing = False
+                raise
+            except Exception as e:
+                if not replica_fault(e):
+                    endpoint.probing = False
+                    raise
+                self._failure(endpoint, repr(e))
+                last_error = e
+                metrics.inc("router_retries")
+            finally:
+                endpoint.inflight -= 1
+                metrics.set_gauge(f"router_inflight:{endpoint.url}", endpoint.inflight)
+
+    def status(self) -> List[dict]:
+        now = time.monotonic()
+        return [{"url": e.url, "inflight": e.inflight, "circuit": e.state(now)} for e in self.endpoints]
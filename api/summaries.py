@@ -0,0 +1,148 @@
+"""
+Rolling per-chat summaries, so long consults keep their early context while
+the prompt stays bounded.
+
+Once a chat has more than SUMMARY_TRIGGER_MESSAGES messages past its summary,
+the older ones (all but the newest SUMMARY_KEEP_RECENT) are folded into
+Chat.summary by a non-streaming call to the model, made through the same
+replica router as generations (or to SUMMARY_ENDPOINT if set). This runs as
+a background task after a reply has been saved, never on the request path.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+import upstream
+import writebehind
+from routing import EndpointRouter
+from models import SessionLocal, Chat, Message
+from prompt import message_tokens, truncate_tokens
+
+# Unsummarized messages a chat may accumulate before a summary pass; 0 disables
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "20"))
+# Newest messages always left verbatim for the prompt's history
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "10"))
+# Transcript tokens sent per pass; a longer backlog is folded in over several passes
+SUMMARY_INPUT_TOKENS = int(os.getenv("SUMMARY_INPUT_TOKENS", "6000"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")
+# A separate server for summaries; by default they go to the generation replicas
+SUMMARY_ENDPOINT = os.getenv("SUMMARY_ENDPOINT")
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a consultation between a doctor and a medical "
+    "assistant. Update the previous summary with the new turns. Keep every clinically "
+    "relevant fact: symptoms, findings, diagnoses considered, medications and doses, "
+    "allergies, and agreed plans. Be concise and factual; do not add advice."
+)
+
+_inflight: Set[str] = set()
+_tasks: Set[asyncio.Task] = set()
+_summary_router: Optional[EndpointRouter] = None
+
+def _router_for(model_router: EndpointRouter) -> EndpointRouter:
+    global _summary_router
+    if not SUMMARY_ENDPOINT:
+        return model_router
+    if _summary_router is None:
+        _summary_router = EndpointRouter([SUMMARY_ENDPOINT])
+    return _summary_router
+
+def schedule(chat_id: str, model_router: EndpointRouter):
+    """Start a background summary pass for the chat unless one is already running"""
+    if SUMMARY_TRIGGER_MESSAGES <= 0 or chat_id in _inflight:
+        return
+    _inflight.add(chat_id)
+    task = asyncio.create_task(_run(chat_id, model_router))
+    # The loop only keeps weak references to tasks
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def _run(chat_id: str, model_router: EndpointRouter):
+    try:
+        await summarize_chat(chat_id, model_router)
+    except Exception as e:
+        metrics.inc("summary_errors")
+        print(f"Summary of chat {chat_id} failed: {e}")
+    finally:
+        _inflight.discard(chat_id)
+
+def _pending(chat_id: str) -> Optional[Tuple[Optional[str], Optional[datetime], List[Message]]]:
+    """(previous summary, its marker, messages to fold in), or None when under the trigger"""
+    writebehind.flush_chat(chat_id)
+    db = SessionLocal()
+    try:
+        chat = db.query(Chat).filter_by(id=chat_id).first()
+        if not chat:
+            return None
+        query = db.query(Message).filter(Message.chat_id == chat_id)
+        if chat.summarized_until:
+            query = query.filter(Message.created_at > chat.summarized_until)
+        unsummarized = query.count()
+        if unsummarized <= SUMMARY_TRIGGER_MESSAGES:
+            return None
+        older = query.order_by(Message.created_at.asc(), Message.id.asc()).limit(
+            max(0, unsummarized - SUMMARY_KEEP_RECENT)).all()
+        batch, used = [], 0
+        for m in older:
+            used += message_tokens(m)
+            if batch and used > SUMMARY_INPUT_TOKENS:
+                break
+            batch.append(m)
+        return chat.summary, chat.summarized_until, batch
+    finally:
+        db.close()
+
+def _transcript(messages: List[Message]) -> str:
+    speaker = {"user": "Doctor", "assistant": "Assistant"}
+    lines = [f"{speaker.get(m.role, m.role)}: {m.text}" for m in messages if m.text]
+    return truncate_tokens("\n".join(lines), SUMMARY_INPUT_TOKENS)
+
+def _store(chat_id: str, summary: str, until: datetime, previous_until: Optional[datetime]) -> bool:
+    db = SessionLocal()
+    try:
+        # Conditional on the old marker so a concurrent pass from another worker wins cleanly
+        updated = db.query(Chat).filter(
+            Chat.id == chat_id,
+            Chat.summarized_until.is_(None) if previous_until is None else Chat.summarized_until == previous_until,
+        ).update({"summary": summary, "summarized_until": until}, synchronize_session=False)
+        db.commit()
+        return bool(updated)
+    finally:
+        db.close()
+
+async def summarize_chat(chat_id: str, model_router: EndpointRouter):
+    """Fold older turns into the chat's summary until it is back under the trigger"""
+    router = _router_for(model_router)
+    headers = upstream.request_headers(router.endpoints[0].url)
+    while True:
+        work = await run_in_threadpool(_pending, chat_id)
+        if work is None or not work[2]:
+            return
+        previous, previous_until, batch = work
+        content = f"Previous summary:\n{previous or '(none)'}\n\nNew turns:\n{_transcript(batch)}"
+        payload = {
+            "model": SUMMARY_MODEL,
+            "messages": [
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                {"role": "user", "content": content},
+            ],
+            "temperature": 0,
+            "max_tokens": SUMMARY_MAX_TOKENS,
+            "stream": False,
+        }
+        start = time.perf_counter()
+        r = await router.post(upstream.get_client(), payload, headers)
+        summary = r.json()["choices"][0]["message"]["content"].strip()
+        metrics.observe("summary_ms", (time.perf_counter() - start) * 1000)
+        if not summary:
+            return
+        if not await run_in_threadpool(_store, chat_id, summary, batch[-1].created_at, previous_until):
+            return
+        metrics.inc("summary_passes")
+        metrics.inc("summary_messages_folded", len(batch))
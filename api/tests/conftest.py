@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, API_DIR)
+
+# app.py reads its configuration at import time, so it is set up here, before any test imports it
+_workdir = tempfile.mkdtemp(prefix="medra-tests-")
+os.chdir(_workdir)
+os.environ["DB_URL"] = f"sqlite:///{_workdir}/test.db"
+os.environ.pop("MODEL_ENDPOINT", None)
+os.environ.pop("SUMMARY_ENDPOINT", None)
+os.environ["MODEL_ENDPOINTS"] = "http://replica-a/v1/chat/completions,http://replica-b/v1/chat/completions"
+os.environ["SUMMARY_TRIGGER_MESSAGES"] = "4"
+os.environ["SUMMARY_KEEP_RECENT"] = "2"
@@ -0,0 +1,109 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import admission
+from admission import AdmissionController
+
+def _run(coro_fn):
+    return asyncio.run(coro_fn())
+
+def test_weighted_fair_queue_interleaves_doctors():
+    async def run():
+        controller = AdmissionController(max_inflight=1, queue_max=100, max_queued_per_doctor=100)
+        blocker = controller.acquire("x")
+        tickets = [controller.acquire(d) for d in ["a"] * 5 + ["b", "c"]]
+        order, running = [], blocker
+        for _ in tickets:
+            controller.release(running)
+            running = next(t for t in tickets if t.granted and not t.released)
+            order.append(running.doctor_id)
+        return order
+    # a's burst only delays a
+    assert _run(run) == ["a", "b", "c", "a", "a", "a", "a"]
+
+def test_full_queue_is_refused_with_429():
+    async def run():
+        controller = AdmissionController(max_inflight=1, queue_max=2, max_queued_per_doctor=10)
+        controller.acquire("a")
+        controller.acquire("b")
+        controller.acquire("c")
+        with pytest.raises(HTTPException) as refused:
+            controller.acquire("d")
+        return refused.value, controller.waiting
+    refused, waiting = _run(run)
+    assert refused.status_code == 429 and refused.headers["Retry-After"]
+    assert waiting == 2
+
+def test_one_doctor_cannot_take_the_whole_queue():
+    async def run():
+        controller = AdmissionController(max_inflight=1, queue_max=10, max_queued_per_doctor=2)
+        controller.acquire("a")
+        controller.acquire("a")
+        controller.acquire("a")
+        with pytest.raises(HTTPException) as refused:
+            controller.acquire("a")
+        assert refused.value.status_code == 429
+        # Others still get in line
+        return controller.acquire("b").granted
+    assert _run(run) is False
+
+def test_queue_timeout_ends_the_stream_and_frees_the_place(monkeypatch):
+    async def run():
+        controller = AdmissionController(max_inflight=1, queue_max=10, max_queued_per_doctor=10)
+        monkeypatch.setattr(admission, "controller", controller)
+        running = controller.acquire("a")
+        queued = controller.acquire("b")
+
+        async def never():
+            raise AssertionError("a timed-out request must not reach the model")
+            yield
+
+        async def wait_briefly(ticket, timeout=0.05):
+            async for position in AdmissionController.wait(controller, ticket, timeout):
+                yield position
+        monkeypatch.setattr(controller, "wait", wait_briefly)
+        frames = [frame async for frame in admission.admitted(queued, never())]
+        return frames, controller, running
+    frames, controller, running = _run(run)
+    assert frames[0].startswith("event: queued")
+    assert frames[-1].startswith("event: error")
+    assert "Timed out" in json.loads(frames[-1].split("data: ", 1)[1])["error"]
+    assert controller.waiting == 0 and not controller.queued_by_doctor
+    assert controller.inflight == 1 and running.granted
+
+def test_cancelled_streams_release_their_place_and_slot(monkeypatch):
+    async def run():
+        controller = AdmissionController(max_inflight=1, queue_max=10, max_queued_per_doctor=10)
+        monkeypatch.setattr(admission, "controller", controller)
+        started = asyncio.Event()
+
+        async def generation():
+            started.set()
+            await asyncio.sleep(3600)
+            yield "never"
+
+        async def consume(ticket):
+            async for _ in admission.admitted(ticket, generation()):
+                pass
+
+        running = asyncio.create_task(consume(controller.acquire("a")))
+        await started.wait()
+        waiting = asyncio.create_task(consume(controller.acquire("b")))
+        last = controller.acquire("c")
+        await asyncio.sleep(0)
+        assert controller.waiting == 2
+
+        # A client that gives up while queued leaves the queue
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert controller.waiting == 1 and "b" not in controller.queued_by_doctor
+
+        # One that gives up mid-generation frees its slot for the next in line
+        running.cancel()
+        await asyncio.gather(running, return_exceptions=True)
+        return controller, last
+    controller, last = _run(run)
+    assert last.granted and controller.inflight == 1 and controller.waiting == 0
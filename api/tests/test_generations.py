@@ -0,0 +1,76 @@
+import asyncio
+
+import generations
+import metrics
+
+def _replayed() -> float:
+    return metrics.snapshot()["counters"].get("generation_frames_replayed", 0)
+
+def test_replayed_frames_counts_only_buffered_frames_sent():
+    async def run():
+        live = asyncio.Queue()
+
+        async def frames():
+            while True:
+                frame = await live.get()
+                if frame is None:
+                    return
+                yield frame
+
+        generation = generations.create("chat", "doctor")
+        generation.start(frames())
+        for i in range(5):
+            await live.put(f"data: {i}\n\n")
+        while generation.last_seq < 5:
+            await asyncio.sleep(0)
+
+        before = _replayed()
+        resumed, after = generations.resume(f"{generation.id}:2", "doctor")
+        assert resumed is generation and after == 2
+        # Accepting the resume replays nothing by itself
+        assert _replayed() == before
+
+        # The client takes one of the three missed frames, then drops again
+        stream = generation.subscribe(after, replay=True)
+        assert (await stream.__anext__()).endswith("data: 2\n\n")
+        await stream.aclose()
+        assert _replayed() == before + 1
+
+        # A full reconnect replays the rest; frames produced afterwards are live, not replayed
+        stream = generation.subscribe(3, replay=True)
+        received = [await stream.__anext__(), await stream.__anext__()]
+        await live.put("data: 5\n\n")
+        received.append(await stream.__anext__())
+        await live.put(None)
+        received += [frame async for frame in stream]
+        assert [frame.split("\n", 1)[1] for frame in received] == ["data: 3\n\n", "data: 4\n\n", "data: 5\n\n"]
+        assert _replayed() == before + 3
+
+    asyncio.run(run())
+
+def test_first_attach_is_not_a_replay():
+    async def run():
+        live = asyncio.Queue()
+
+        async def frames():
+            while True:
+                frame = await live.get()
+                if frame is None:
+                    return
+                yield frame
+
+        generation = generations.create("chat", "doctor")
+        generation.start(frames())
+        # Frames produced before the first client reads are still its first delivery
+        for i in range(3):
+            await live.put(f"data: {i}\n\n")
+        while generation.last_seq < 3:
+            await asyncio.sleep(0)
+        await live.put(None)
+
+        before = _replayed()
+        received = [frame async for frame in generation.subscribe(0)]
+        assert len(received) == 3
+        assert _replayed() == before
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt as google_jwt
+
+import google_certs
+
+AUDIENCE = "client-id.apps.googleusercontent.com"
+
+def _key_and_cert():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "stand-in")])
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(datetime.utcnow() - timedelta(days=1))
+            .not_valid_after(datetime.utcnow() + timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode()
+    return key_pem, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+def _token(key_pem: str, kid: str) -> str:
+    now = int(time.time())
+    payload = {"iss": "https://accounts.google.com", "aud": AUDIENCE, "sub": "42",
+               "email": "dr@example.com", "iat": now, "exp": now + 600}
+    return google_jwt.encode(crypt.RSASigner.from_string(key_pem, kid), payload).decode()
+
+@pytest.fixture
+def certs_server(monkeypatch):
+    """A stand-in for Google's certs endpoint; tests change what it serves through `state`"""
+    state = SimpleNamespace(certs={}, max_age=100, status=200, requests=0)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state.requests += 1
+            body = json.dumps(state.certs).encode()
+            self.send_response(state.status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", f"public, max-age={state.max_age}, must-revalidate")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(google_certs, "time", SimpleNamespace(monotonic=lambda: clock.now,
+                                                              perf_counter=time.perf_counter))
+    monkeypatch.setattr(google_certs, "GOOGLE_CERTS_URL", f"http://127.0.0.1:{server.server_port}/certs")
+    monkeypatch.setattr(google_certs, "GOOGLE_CERTS_REFRESH_MARGIN", 0)
+    monkeypatch.setattr(google_certs, "_certs", None)
+    monkeypatch.setattr(google_certs, "_expires_at", 0.0)
+    monkeypatch.setattr(google_certs, "_fetched_at", float("-inf"))
+    state.clock = clock
+    yield state
+    server.shutdown()
+    server.server_close()
+
+def test_cache_control_max_age_is_honoured(certs_server):
+    certs_server.certs = {"k1": "pem-1"}
+    assert google_certs.get_certs() == {"k1": "pem-1"}
+    certs_server.certs = {"k2": "pem-2"}
+    certs_server.clock.now += 99
+    assert google_certs.get_certs() == {"k1": "pem-1"}
+    assert certs_server.requests == 1
+    certs_server.clock.now += 2
+    assert google_certs.get_certs() == {"k2": "pem-2"}
+    assert certs_server.requests == 2
+
+def test_stale_certs_are_served_while_refresh_fails(certs_server):
+    certs_server.certs = {"k1": "pem-1"}
+    google_certs.get_certs()
+    certs_server.status = 503
+    certs_server.clock.now += 100 + google_certs.GOOGLE_CERTS_MAX_STALE - 1
+    assert google_certs.get_certs() == {"k1": "pem-1"}
+    assert certs_server.requests == 2
+    # Past the stale allowance the failure surfaces
+    certs_server.clock.now += 2
+    with pytest.raises(Exception):
+        google_certs.get_certs()
+
+def test_unknown_kid_forces_a_refresh(certs_server):
+    old_key, old_cert = _key_and_cert()
+    new_key, new_cert = _key_and_cert()
+    certs_server.certs = {"old": old_cert}
+    assert google_certs.verify_google_id_token(_token(old_key, "old"), AUDIENCE)["sub"] == "42"
+    # Google publishes the rotated key before signing with it; our cache is still fresh
+    certs_server.certs = {"old": old_cert, "new": new_cert}
+    certs_server.clock.now += google_certs.FORCED_REFRESH_INTERVAL
+    idinfo = google_certs.verify_google_id_token(_token(new_key, "new"), AUDIENCE)
+    assert idinfo["email"] == "dr@example.com"
+    assert certs_server.requests == 2
@@ -0,0 +1,28 @@
+import os
+import time
+
+import media
+
+def test_orphan_sweep_spares_young_and_linked_blobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(media.BLOB_DIR)
+    os.makedirs("storage")
+    old = time.time() - 2 * media.BLOB_GC_GRACE
+
+    def blob(name, age=None, linked=False):
+        path = os.path.join(media.BLOB_DIR, name)
+        with open(path, "wb") as f:
+            f.write(name.encode())
+        if linked:
+            os.link(path, os.path.join("storage", name))
+        if age is not None:
+            os.utime(path, (age, age))
+        return path
+
+    orphan = blob("orphan", age=old)
+    fresh = blob("fresh")  # written by another worker, not linked yet
+    linked = blob("linked", age=old, linked=True)
+
+    assert media.collect_orphan_blobs() == 1
+    assert not os.path.exists(orphan)
+    assert os.path.exists(fresh) and os.path.exists(linked)
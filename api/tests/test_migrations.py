@@ -0,0 +1,41 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conftest import API_DIR
+from migrations import MIGRATIONS
+
+# The tables as they were before any numbered migration
+OLD_SCHEMA = """
+CREATE TABLE doctors (id VARCHAR PRIMARY KEY, email VARCHAR NOT NULL UNIQUE, name VARCHAR, password_hash VARCHAR,
+    google_id VARCHAR, avatar_url VARCHAR, specialty VARCHAR, license_number VARCHAR, phone VARCHAR,
+    created_at DATETIME, last_login DATETIME);
+CREATE TABLE patients (id VARCHAR PRIMARY KEY, doctor_id VARCHAR, name VARCHAR NOT NULL, mrn VARCHAR, notes TEXT,
+    created_at DATETIME);
+CREATE TABLE chats (id VARCHAR PRIMARY KEY, doctor_id VARCHAR, patient_id VARCHAR, patient_name VARCHAR,
+    title VARCHAR, is_general VARCHAR, created_at DATETIME);
+CREATE TABLE messages (id VARCHAR PRIMARY KEY, chat_id VARCHAR, doctor_id VARCHAR, patient_id VARCHAR,
+    patient_name VARCHAR, role VARCHAR, text TEXT, media_url VARCHAR, media_type VARCHAR, file_name VARCHAR,
+    created_at DATETIME);
+"""
+
+def test_concurrent_workers_migrate_sqlite_once(tmp_path):
+    db = tmp_path / "old.db"
+    with sqlite3.connect(db) as conn:
+        conn.executescript(OLD_SCHEMA)
+    env = {**os.environ, "PYTHONPATH": API_DIR, "DB_URL": f"sqlite:///{db}"}
+    code = "import models; from migrations import run_migrations; run_migrations(models.engine)"
+    workers = [
+        subprocess.Popen([sys.executable, "-c", code], env=env, cwd=tmp_path,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for _ in range(8)
+    ]
+    for worker in workers:
+        output, _ = worker.communicate(timeout=60)
+        assert worker.returncode == 0, output
+    with sqlite3.connect(db) as conn:
+        versions = [row[0] for row in conn.execute("SELECT version FROM schema_migrations")]
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(chats)")}
+    assert sorted(versions) == [version for version, _ in MIGRATIONS]
+    assert {"summary", "summarized_until"} <= columns
@@ -0,0 +1,100 @@
+import asyncio
+import base64
+import uuid
+from datetime import datetime
+
+import httpx
+
+import app
+from auth import make_token
+from models import SessionLocal, async_engine, Doctor, Chat, Message
+from pagination import NEXT_CURSOR_HEADER
+
+# Every row shares one timestamp, so only the id tie-break keeps pages apart
+SAME_TIME = datetime(2024, 5, 1, 9, 30)
+
+def _seed(messages: int, chats: int):
+    db = SessionLocal()
+    try:
+        doctor = Doctor(email=f"{uuid.uuid4().hex}@pagination")
+        db.add(doctor)
+        db.flush()
+        chat_ids = []
+        for i in range(chats):
+            chat = Chat(doctor_id=doctor.id, title=f"Chat {i}", is_general="true", created_at=SAME_TIME)
+            db.add(chat)
+            db.flush()
+            chat_ids.append(chat.id)
+        for i in range(messages):
+            db.add(Message(chat_id=chat_ids[0], doctor_id=doctor.id, role="user", text=f"m{i}", created_at=SAME_TIME))
+        db.commit()
+        return {"Authorization": f"Bearer {make_token(doctor.id, doctor.email)}"}, chat_ids
+    finally:
+        db.close()
+
+def _get(*requests):
+    """Run GET requests (path, params, headers) in order against the app; later ones may use earlier results"""
+    async def run():
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://test") as client:
+                return [await client.get(path, params=params, headers=headers) for path, params, headers in requests]
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
+
+def _walk(path: str, params: dict, headers: dict):
+    """Follow X-Next-Cursor from the first page to the last; returns the pages"""
+    async def run():
+        pages, cursor = [], None
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://test") as client:
+                while True:
+                    r = await client.get(path, params={**params, **({"cursor": cursor} if cursor else {})},
+                                         headers=headers)
+                    assert r.status_code == 200, r.text
+                    pages.append(r.json())
+                    cursor = r.headers.get(NEXT_CURSOR_HEADER)
+                    if not cursor:
+                        return pages
+                    assert len(pages) < 50, "cursor never ran out"
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
+
+def test_message_pages_split_equal_timestamps_on_id():
+    headers, (chat_id,) = _seed(messages=7, chats=1)
+    pages = _walk("/messages", {"chat_id": chat_id, "limit": 3}, headers)
+    assert [len(p) for p in pages] == [3, 3, 1]
+    ids = [m["id"] for page in pages for m in page]
+    assert len(set(ids)) == 7
+    # Newest page first, each page in chronological (here: id) order
+    for page, older in zip(pages, pages[1:]):
+        assert min(m["id"] for m in page) > max(m["id"] for m in older)
+    for page in pages:
+        assert [m["id"] for m in page] == sorted(m["id"] for m in page)
+    assert sorted(ids) == sorted(m["id"] for m in _get(("/messages", {"chat_id": chat_id}, headers))[0].json())
+
+def test_chat_pages_round_trip_the_cursor():
+    headers, chat_ids = _seed(messages=0, chats=5)
+    pages = _walk("/chats/general", {"limit": 2}, headers)
+    assert [len(p) for p in pages] == [2, 2, 1]
+    ids = [c["id"] for page in pages for c in page]
+    assert ids == sorted(chat_ids, reverse=True)
+
+def test_malformed_cursor_is_a_400():
+    headers, (chat_id,) = _seed(messages=1, chats=1)
+    junk = base64.urlsafe_b64encode(b"not a cursor").decode().rstrip("=")
+    responses = _get(
+        ("/messages", {"chat_id": chat_id, "cursor": "%%%"}, headers),
+        ("/messages", {"chat_id": chat_id, "cursor": junk}, headers),
+        ("/chats/general", {"cursor": junk}, headers),
+    )
+    assert [r.status_code for r in responses] == [400, 400, 400]
+
+def test_no_limit_or_cursor_returns_everything_without_a_cursor():
+    headers, (chat_id,) = _seed(messages=3, chats=1)
+    messages, chats = _get(("/messages", {"chat_id": chat_id}, headers), ("/chats/general", {}, headers))
+    assert NEXT_CURSOR_HEADER not in messages.headers and NEXT_CURSOR_HEADER not in chats.headers
+    assert isinstance(messages.json(), list) and len(messages.json()) == 3
+    assert {"id", "role", "text", "media_url"} <= set(messages.json()[0])
+    assert [c["id"] for c in chats.json()] == [chat_id]
@@ -0,0 +1,23 @@
+from types import SimpleNamespace
+
+import prompt
+
+GREEK = "Ο ασθενής παρουσιάζει πυρετό 39°C, δύσπνοια και αλλεργία στην πενικιλίνη."
+
+def test_estimate_leaves_a_margin_for_non_latin_text(monkeypatch):
+    monkeypatch.setattr(prompt, "_encoding", None)
+    # Byte-level BPE needs well over a token per 4 characters for Greek
+    assert prompt.count_tokens(GREEK) >= len(GREEK) // 2
+    cut = prompt.truncate_tokens(GREEK, 10)
+    assert GREEK.startswith(cut) and prompt.count_tokens(cut) <= 10
+
+def test_cached_counts_from_another_tokenizer_are_recounted(monkeypatch):
+    monkeypatch.setattr(prompt, "_encoding", None)
+    monkeypatch.setattr(prompt, "TOKEN_COUNTER", "estimate")
+    message = SimpleNamespace(text=GREEK, token_count=3, token_counter="cl100k_base")
+    assert prompt.message_tokens(message) == prompt.count_tokens(GREEK)
+    assert message.token_counter == "estimate"
+
+    message.token_count = 3
+    # Same tokenizer: the cached count is trusted
+    assert prompt.message_tokens(message) == 3
@@ -0,0 +1,63 @@
+import asyncio
+
+import httpx
+import pytest
+
+from routing import EndpointRouter, ROUTER_BREAKER_FAILURES
+
+URLS = ["http://replica-a/v1/chat/completions", "http://replica-b/v1/chat/completions"]
+
+def _post(router: EndpointRouter, handler) -> httpx.Response:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await router.post(client, {}, {})
+    return asyncio.run(run())
+
+def _stream(router: EndpointRouter, handler) -> list:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return [line async for line in router.stream_lines(client, {}, {})]
+    return asyncio.run(run())
+
+def test_client_errors_are_not_retried_or_counted():
+    router = EndpointRouter(URLS)
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.host)
+        return httpx.Response(400, json={"error": "context too long"})
+
+    for _ in range(ROUTER_BREAKER_FAILURES + 1):
+        with pytest.raises(httpx.HTTPStatusError):
+            _stream(router, handler)
+        with pytest.raises(httpx.HTTPStatusError):
+            _post(router, handler)
+    # One attempt per call, and every circuit still closed
+    assert len(calls) == 2 * (ROUTER_BREAKER_FAILURES + 1)
+    assert all(e.failures == 0 for e in router.endpoints)
+    assert {s["circuit"] for s in router.status()} == {"closed"}
+
+def test_server_errors_fail_over_and_count():
+    router = EndpointRouter(URLS)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "replica-a":
+            return httpx.Response(502)
+        return httpx.Response(200, text="data: ok\n\n")
+
+    for _ in range(ROUTER_BREAKER_FAILURES):
+        assert _stream(router, handler)[0] == "data: ok"
+    replica_a = router.endpoints[0]
+    assert replica_a.failures >= 1
+
+def test_connection_errors_fail_over():
+    router = EndpointRouter(URLS)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "replica-a":
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200, json={"ok": True})
+
+    for _ in range(2):
+        assert _post(router, handler).json() == {"ok": True}
+    assert router.endpoints[0].failures >= 1
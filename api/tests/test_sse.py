@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import sse
+
+def _texts(frames):
+    return [json.loads(f[len("data: "):])["delta"] for f in frames]
+
+def _collect(items, **kwargs):
+    """Run `items` through coalesce; a float is a pause in seconds, a str a delta"""
+    async def source():
+        for item in items:
+            if isinstance(item, float):
+                await asyncio.sleep(item)
+            else:
+                yield sse.Delta(item) if not item.startswith("event:") else item
+
+    async def run():
+        return [frame async for frame in sse.coalesce(source(), **kwargs)]
+    return asyncio.run(run())
+
+def test_first_delta_goes_out_alone():
+    assert _texts(_collect(["a", "b", "c"], window_ms=1000, max_bytes=1024)) == ["a", "bc"]
+
+def test_window_flushes_a_partial_batch_while_upstream_is_quiet():
+    frames = _collect(["a", "b", "c", 0.2, "d", "e"], window_ms=50, max_bytes=1024)
+    assert _texts(frames) == ["a", "bc", "de"]
+
+def test_byte_cap_flushes_before_the_window():
+    frames = _collect(["a"] + ["xyz"] * 5, window_ms=10_000, max_bytes=6)
+    assert _texts(frames) == ["a", "xyzxyz", "xyzxyz", "xyz"]
+
+def test_end_of_stream_flushes_pending_text_before_other_events():
+    end = "event: end\ndata: [DONE]\n\n"
+    frames = _collect(["a", "b", "c", end], window_ms=10_000, max_bytes=1024)
+    assert frames[-1] == end
+    assert _texts(frames[:-1]) == ["a", "bc"]
+    # And when the stream simply stops
+    assert _texts(_collect(["a", "b"], window_ms=10_000, max_bytes=1024)) == ["a", "b"]
+
+def test_no_task_per_delta_while_no_batch_is_open(monkeypatch):
+    created = []
+    ensure_future = asyncio.ensure_future
+    monkeypatch.setattr(sse.asyncio, "ensure_future", lambda aw: created.append(1) or ensure_future(aw))
+    assert _texts(_collect(["a", "b", "c"], window_ms=0, max_bytes=1024)) == ["a", "b", "c"]
+    assert not created
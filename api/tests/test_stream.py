@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import httpx
+
+import app
+import metrics
+import upstream
+from auth import make_token
+from models import SessionLocal, async_engine, Doctor, Message
+
+def _counter(name: str) -> float:
+    return metrics.snapshot()["counters"].get(name, 0)
+
+def _upstream(calls: list):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(json.loads(request.content))
+
+        async def body():
+            await asyncio.sleep(0.3)
+            for token in ("Rest ", "and ", "fluids."):
+                yield f"data: {json.dumps({'choices': [{'delta': {'content': token}}]})}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+        return httpx.Response(200, content=body(), headers={"content-type": "text/event-stream"})
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+def _doctor_headers() -> dict:
+    db = SessionLocal()
+    try:
+        doctor = Doctor(email=f"{id(db)}-stream@test", name="Dr Test")
+        db.add(doctor)
+        db.commit()
+        return {"Authorization": f"Bearer {make_token(doctor.id, doctor.email)}"}
+    finally:
+        db.close()
+
+def test_double_tap_with_fresh_keys_shares_one_generation():
+    headers = _doctor_headers()
+    calls = []
+
+    async def run():
+        upstream._client = _upstream(calls)
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://test") as client:
+                chat_id = (await client.post("/chats/general", headers=headers)).json()["id"]
+                started = _counter("generations_started")
+                body = {"chat_id": chat_id, "prompt": "Fever for three days, what next?"}
+                first, second = await asyncio.gather(*(
+                    client.post("/stream", json=body, headers={**headers, "Idempotency-Key": key})
+                    for key in ("first-tap", "second-tap")
+                ))
+                assert _counter("generations_started") == started + 1
+                return chat_id, first, second
+        finally:
+            await upstream.close_client()
+            await async_engine.dispose()
+
+    chat_id, first, second = asyncio.run(run())
+    assert first.headers["X-Generation-Id"] == second.headers["X-Generation-Id"]
+    assert "event: end" in first.text and "event: end" in second.text
+    assert len(calls) == 1
+    db = SessionLocal()
+    try:
+        roles = [m.role for m in db.query(Message).filter_by(chat_id=chat_id)]
+    finally:
+        db.close()
+    assert sorted(roles) == ["assistant", "user"]
@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+
+import app
+import summaries
+import upstream
+from models import SessionLocal, Doctor, Chat, Message
+
+def _chat_with_turns(count: int) -> str:
+    db = SessionLocal()
+    try:
+        doctor = Doctor(email=f"{datetime.utcnow().timestamp()}@test")
+        db.add(doctor)
+        db.flush()
+        chat = Chat(doctor_id=doctor.id, title="Consult", is_general="true")
+        db.add(chat)
+        db.flush()
+        start = datetime.utcnow() - timedelta(minutes=count)
+        for i in range(count):
+            db.add(Message(chat_id=chat.id, doctor_id=doctor.id, role="user" if i % 2 == 0 else "assistant",
+                           text=f"turn {i}", created_at=start + timedelta(minutes=i)))
+        db.commit()
+        return chat.id
+    finally:
+        db.close()
+
+def _summarize(chat_id: str, handler) -> Chat:
+    async def run():
+        upstream._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            await summaries.summarize_chat(chat_id, app.model_router)
+        finally:
+            await upstream.close_client()
+    asyncio.run(run())
+    db = SessionLocal()
+    try:
+        return db.query(Chat).filter_by(id=chat_id).first()
+    finally:
+        db.close()
+
+def _reply(content: str) -> httpx.Response:
+    return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+
+def test_summary_uses_model_endpoints_replicas():
+    assert app.model_router.endpoints and not summaries.SUMMARY_ENDPOINT
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(str(request.url))
+        return _reply("Folded summary")
+
+    chat = _summarize(_chat_with_turns(6), handler)
+    assert chat.summary == "Folded summary"
+    assert chat.summarized_until is not None
+    assert seen and all(url in app.MODEL_ENDPOINTS for url in seen)
+
+def test_summary_fails_over_to_another_replica():
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request.url.host)
+        if request.url.host == "replica-a":
+            return httpx.Response(503)
+        return _reply("From replica b")
+
+    chat = _summarize(_chat_with_turns(6), handler)
+    assert chat.summary == "From replica b"
+    assert "replica-b" in seen
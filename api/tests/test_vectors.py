@@ -0,0 +1,20 @@
+import numpy as np
+
+from vectors import DoctorVectors
+
+def test_search_breaks_ties_newest_first():
+    doctor = DoctorVectors("doctor", 2, max_rows=100)
+    same = np.array([1.0, 0.0], dtype=np.float32)
+    for message_id in range(1, 11):
+        doctor._append(message_id, "patient", same)
+    doctor._append(11, "patient", np.array([0.0, 1.0], dtype=np.float32))
+    hits = doctor.search(same, None, k=3)
+    assert [message_id for _, message_id in hits] == [10, 9, 8]
+
+def test_search_ranks_by_score_before_recency():
+    doctor = DoctorVectors("doctor", 2, max_rows=100)
+    doctor._append(1, "patient", np.array([1.0, 0.0], dtype=np.float32))
+    doctor._append(2, "patient", np.array([0.6, 0.8], dtype=np.float32))
+    doctor._append(3, "patient", np.array([0.6, 0.8], dtype=np.float32))
+    hits = doctor.search(np.array([1.0, 0.0], dtype=np.float32), None, k=2)
+    assert [message_id for _, message_id in hits] == [1, 3]
@@ -0,0 +1,49 @@
+import os
+from typing import Optional
+
+import httpx
+
+# One pooled client per worker for all calls to the model server. Connections
+# are kept alive between turns, so a generation no longer pays a fresh TCP/TLS
+# handshake, and streams wait on the event loop instead of holding a thread.
+MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "500"))
+MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "100"))
+KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "600"))
+# Time to wait for a free pooled connection before failing the request
+POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "30"))
+# HTTP/2 multiplexes streams over one connection; needs the h2 package
+HTTP2 = os.getenv("UPSTREAM_HTTP2", "0") == "1"
+
+_client: Optional[httpx.AsyncClient] = None
+
+def request_headers(endpoint: str) -> dict:
+    """Headers for a model call, with the OpenAI key when talking to OpenAI"""
+    headers = {"Content-Type": "application/json"}
+    if "openai.com" in endpoint:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if api_key and api_key != "your-openai-api-key-here":
+            headers["Authorization"] = f"Bearer {api_key}"
+    return headers
+
+def get_client() -> httpx.AsyncClient:
+    """Return the worker's shared upstream client, creating it on first use"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=HTTP2,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT),
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,254 @@
+import glob
+import importlib
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, List, Optional, Protocol, Tuple
+
+import numpy as np
+
+from cache import LRUCache
+
+# Per-doctor embedding snapshots: {doctor}.{last_id}.npy holds a contiguous
+# float32 (rows, dim) matrix that is memory-mapped read-only, and the matching
+# {doctor}.{last_id}.ids.npy holds the message ids. The ids file is written
+# last, so its presence marks a complete pair.
+VECTOR_DIR = os.getenv("RAG_VECTOR_DIR", "rag_vectors")
+# "module:factory" returning an Embedder; empty uses the offline HashingEmbedder
+EMBEDDER = os.getenv("RAG_EMBEDDER", "")
+VECTOR_CACHE_MB = int(os.getenv("RAG_VECTOR_CACHE_MB", "256"))
+# Rows appended in memory before they are folded into a new snapshot
+SNAPSHOT_EVERY = int(os.getenv("RAG_VECTOR_SNAPSHOT_EVERY", "256"))
+
+_TOKEN_RE = re.compile(r'\w+')
+
+class Embedder(Protocol):
+    dim: int
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return an L2-normalised float32 array of shape (len(texts), dim)"""
+        ...
+
+class HashingEmbedder:
+    """
+    Deterministic offline embedder: signed feature hashing of unigrams and bigrams
+    with sublinear term frequency. crc32 keeps buckets stable across processes.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        rows, cols, signs = [], [], []
+        for row, text in enumerate(texts):
+            tokens = _TOKEN_RE.findall(text.lower())
+            for feature in tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]:
+                h = zlib.crc32(feature.encode("utf-8"))
+                rows.append(row)
+                cols.append(h % self.dim)
+                signs.append(1.0 if h & 0x80000000 else -1.0)
+        np.add.at(out, (rows, cols), signs)
+        out = np.sign(out) * np.log1p(np.abs(out))
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        np.divide(out, norms, out=out, where=norms > 0)
+        return out
+
+_embedder: Optional[Embedder] = None
+
+def get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        if EMBEDDER:
+            module, _, factory = EMBEDDER.partition(":")
+            _embedder = getattr(importlib.import_module(module), factory)()
+        else:
+            _embedder = HashingEmbedder()
+    return _embedder
+
+def set_embedder(embedder: Embedder):
+    """Plug in a different embedder; resident matrices are dropped so they re-embed"""
+    global _embedder
+    _embedder = embedder
+    _doctors.clear()
+
+def to_blob(vector: np.ndarray) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def _safe_name(doctor_id: str) -> str:
+    return re.sub(r'[^\w-]', '_', doctor_id)
+
+class DoctorVectors:
+    """
+    One doctor's embeddings: a memory-mapped snapshot plus a small in-memory
+    tail of rows added since, both contiguous float32 matrices. Ids are
+    ascending, so the newest max_rows rows are the ones still under the cap.
+    """
+
+    def __init__(self, doctor_id: str, dim: int, max_rows: int):
+        self.doctor_id = doctor_id
+        self.dim = dim
+        self.max_rows = max_rows
+        self.snapshot = np.zeros((0, dim), dtype=np.float32)
+        self.tail = np.zeros((64, dim), dtype=np.float32)
+        self.tail_n = 0
+        self.ids: List[int] = []
+        self.patients: List[Optional[str]] = []
+        self.alive: List[bool] = []
+        self.last_id = 0
+        self.lock = threading.Lock()
+        self._arrays: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+    @property
+    def nbytes(self) -> int:
+        return (len(self.snapshot) + len(self.tail)) * self.dim * 4
+
+    def _prefix(self) -> str:
+        return os.path.join(VECTOR_DIR, _safe_name(self.doctor_id))
+
+    def load(self, conn: sqlite3.Connection):
+        """Map the newest complete snapshot, then catch up from SQLite"""
+        live = dict(conn.execute(
+            "SELECT id, patient_id FROM rag_messages WHERE doctor_id = ? ORDER BY id", (self.doctor_id,)
+        ).fetchall())
+        snapshots = sorted(glob.glob(self._prefix() + ".*.ids.npy"),
+                           key=lambda p: int(p.rsplit(".", 3)[-3]))
+        if snapshots:
+            ids_path = snapshots[-1]
+            try:
+                ids = np.load(ids_path)
+                matrix = np.load(ids_path[:-len(".ids.npy")] + ".npy", mmap_mode="r")
+                if matrix.shape == (len(ids), self.dim):
+                    self.snapshot = matrix
+                    self.ids = ids.tolist()
+                    self.patients = [live.get(i) for i in self.ids]
+                    self.alive = [i in live for i in self.ids]
+                    self.last_id = self.ids[-1] if self.ids else 0
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable vector snapshot {ids_path}: {e}")
+        self.catch_up(conn)
+
+    def catch_up(self, conn: sqlite3.Connection):
+        """Append rows written since last_id, embedding any that have no stored vector"""
+        rows = conn.execute(
+            """SELECT m.id, m.patient_id, m.text, v.embedding FROM rag_messages m
+               LEFT JOIN rag_vectors v ON v.message_id = m.id AND v.dim = ?
+               WHERE m.doctor_id = ? AND m.id > ? ORDER BY m.id""",
+            (self.dim, self.doctor_id, self.last_id),
+        ).fetchall()
+        if not rows:
+            return
+        missing = [i for i, row in enumerate(rows) if row[3] is None]
+        embedded = get_embedder().embed([rows[i][2] for i in missing]) if missing else None
+        if missing:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO rag_vectors (message_id, dim, embedding) VALUES (?, ?, ?)",
+                [(rows[i][0], self.dim, to_blob(vec)) for i, vec in zip(missing, embedded)],
+            )
+            conn.execute("COMMIT")
+        fresh = dict(zip(missing, embedded)) if missing else {}
+        for i, (message_id, patient_id, _, blob) in enumerate(rows):
+            vector = fresh[i] if i in fresh else np.frombuffer(blob, dtype=np.float32)
+            self._append(message_id, patient_id, vector)
+        if self.tail_n >= SNAPSHOT_EVERY:
+            self._write_snapshot()
+
+    def _append(self, message_id: int, patient_id: Optional[str], vector: np.ndarray):
+        if self.tail_n == len(self.tail):
+            grown = np.zeros((len(self.tail) * 2, self.dim), dtype=np.float32)
+            grown[:self.tail_n] = self.tail[:self.tail_n]
+            self.tail = grown
+        self.tail[self.tail_n] = vector
+        self.tail_n += 1
+        self.ids.append(message_id)
+        self.patients.append(patient_id)
+        self.alive.append(True)
+        self.last_id = message_id
+        self._arrays = None
+
+    def _write_snapshot(self):
+        keep = slice(max(0, len(self.ids) - self.max_rows), len(self.ids))
+        matrix = np.concatenate([self.snapshot, self.tail[:self.tail_n]])[keep]
+        ids = np.asarray(self.ids[keep], dtype=np.int64)
+        os.makedirs(VECTOR_DIR, exist_ok=True)
+        base = f"{self._prefix()}.{self.last_id}"
+        for path, array in ((base + ".npy", matrix), (base + ".ids.npy", ids)):
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp, path)
+        for old in glob.glob(self._prefix() + ".*.npy"):
+            if not old.startswith(base + "."):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        self.snapshot = np.load(base + ".npy", mmap_mode="r")
+        self.ids, self.patients, self.alive = self.ids[keep], self.patients[keep], self.alive[keep]
+        self.tail = np.zeros((64, self.dim), dtype=np.float32)
+        self.tail_n = 0
+        self._arrays = None
+
+    def _aligned(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._arrays is None:
+            self._arrays = (np.asarray(self.ids, dtype=np.int64),
+                            np.asarray(self.patients, dtype=object),
+                            np.asarray(self.alive, dtype=bool))
+        return self._arrays
+
+    def search(self, query: np.ndarray, patient_id: Optional[str], k: int,
+               keyword_scores: Optional[Dict[int, float]] = None, alpha: float = 1.0,
+               min_score: float = 0.0) -> List[Tuple[float, int]]:
+        """
+        Top-k (score, message_id) by cosine similarity, optionally blended with
+        keyword scores as alpha * vector + (1 - alpha) * normalised keyword.
+        """
+        with self.lock:
+            ids, patients, alive = self._aligned()
+            if not len(ids):
+                return []
+            # One matrix-vector product per block; the snapshot is never copied
+            scores = np.concatenate([self.snapshot @ query, self.tail[:self.tail_n] @ query])
+        mask = alive.copy()
+        mask[:max(0, len(ids) - self.max_rows)] = False
+        if patient_id:
+            mask &= patients == patient_id
+        if keyword_scores:
+            hit_ids = np.fromiter(keyword_scores.keys(), dtype=np.int64)
+            hit_scores = np.fromiter(keyword_scores.values(), dtype=np.float32)
+            pos = np.minimum(np.searchsorted(ids, hit_ids), len(ids) - 1)
+            found = ids[pos] == hit_ids
+            keyword = np.zeros(len(ids), dtype=np.float32)
+            keyword[pos[found]] = hit_scores[found] / hit_scores.max()
+            scores = alpha * scores + (1 - alpha) * keyword
+        scores = np.where(mask, scores, -np.inf)
+        k = min(k, int(mask.sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        # Rows tied with the k-th score may straddle the cut; take them all so that,
+        # as in keyword search, ties go to the newest message
+        top = np.flatnonzero(scores >= scores[top].min())
+        top = top[np.lexsort((-ids[top], -scores[top]))][:k]
+        return [(float(scores[i]), int(ids[i])) for i in top if scores[i] > min_score]
+
+_doctors = LRUCache(VECTOR_CACHE_MB * 1024 * 1024)
+
+def get_doctor_vectors(doctor_id: str, conn: sqlite3.Connection, max_rows: int) -> DoctorVectors:
+    """Return the doctor's resident embeddings, loading them lazily and syncing new rows"""
+    doctor = _doctors.get(doctor_id)
+    if doctor is None:
+        doctor = DoctorVectors(doctor_id, get_embedder().dim, max_rows)
+        with doctor.lock:
+            doctor.load(conn)
+    else:
+        with doctor.lock:
+            doctor.catch_up(conn)
+    _doctors.put(doctor_id, doctor, weight=doctor.nbytes)
+    return doctor
+
+def is_resident(doctor_id: str) -> bool:
+    return doctor_id in _doctors
@@ -0,0 +1,155 @@
+"""
+Write-behind persistence of chat turns.
+
+/stream does not write its turns on the request path. It hands each
+Message (the user's prompt, then the reply) to a single writer thread. That
+thread takes whatever is queued, up to WRITEBEHIND_BATCH turns, and writes
+them with one database commit and one RAG transaction. Because there is a
+single FIFO writer, each chat's turns land in order. A generation waits for
+its chat's turns to be committed before it sends its `end` event, so a client
+that has seen the end reads them back from any worker. Code in this worker
+that reads a chat's turns mid-generation calls flush_chat() first, and
+shutdown drains the queue. Flushes wait for the commit only; RAG indexing of
+the batch follows it and may lag by a batch.
+
+The queue is bounded. When it is full, submitters wait, which slows
+generation down rather than dropping turns. Turns still queued when the
+process is killed outright are lost.
+"""
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from models import SessionLocal, Message
+from prompt import message_tokens
+from rag import save_conversation_contexts
+
+WRITEBEHIND_QUEUE_MAX = int(os.getenv("WRITEBEHIND_QUEUE_MAX", "1000"))
+WRITEBEHIND_BATCH = int(os.getenv("WRITEBEHIND_BATCH", "64"))
+# Seconds a reader waits for a chat's queued turns before reading anyway
+WRITEBEHIND_FLUSH_TIMEOUT = float(os.getenv("WRITEBEHIND_FLUSH_TIMEOUT", "10"))
+
+_queue: "queue.Queue[Optional[Message]]" = queue.Queue(WRITEBEHIND_QUEUE_MAX)
+_pending: Dict[str, int] = {}  # chat id -> turns queued or being written
+_cond = threading.Condition()
+_thread: Optional[threading.Thread] = None
+_start_lock = threading.Lock()
+
+def start():
+    global _thread
+    with _start_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="write-behind", daemon=True)
+            _thread.start()
+
+def stop():
+    """Write everything queued, then stop the writer"""
+    if _thread is not None and _thread.is_alive():
+        _queue.put(None)
+        _thread.join()
+
+def _track(chat_id: str, delta: int):
+    with _cond:
+        left = _pending.get(chat_id, 0) + delta
+        if left:
+            _pending[chat_id] = left
+        else:
+            _pending.pop(chat_id, None)
+            _cond.notify_all()
+
+def submit(message: Message, block: bool = True) -> bool:
+    """Queue a turn for writing; False if the queue is full and `block` is off"""
+    start()
+    _track(message.chat_id, 1)
+    try:
+        _queue.put(message, block=block)
+    except queue.Full:
+        _track(message.chat_id, -1)
+        return False
+    metrics.set_gauge("writebehind_queue_depth", _queue.qsize())
+    return True
+
+async def submit_async(message: Message):
+    """submit() for the event loop: a full queue is waited on in the threadpool"""
+    if not submit(message, block=False):
+        metrics.inc("writebehind_queue_full")
+        await run_in_threadpool(submit, message)
+
+def flush_chat(chat_id: str, timeout: float = WRITEBEHIND_FLUSH_TIMEOUT) -> bool:
+    """Wait until the chat's queued turns are committed; False on timeout"""
+    with _cond:
+        flushed = _cond.wait_for(lambda: chat_id not in _pending, timeout)
+    if not flushed:
+        metrics.inc("writebehind_flush_timeouts")
+    return flushed
+
+async def flush_chat_async(chat_id: str) -> bool:
+    """flush_chat() for the event loop; only waits in the threadpool if the chat has queued turns"""
+    if chat_id not in _pending:
+        return True
+    return await run_in_threadpool(flush_chat, chat_id)
+
+def _run():
+    while True:
+        batch = [_queue.get()]
+        while len(batch) < WRITEBEHIND_BATCH:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        stopping = None in batch
+        batch = [m for m in batch if m is not None]
+        if batch:
+            try:
+                written = _write(batch)
+            finally:
+                for m in batch:
+                    _track(m.chat_id, -1)
+            _index(written)
+        metrics.set_gauge("writebehind_queue_depth", _queue.qsize())
+        if stopping and _queue.empty():
+            return
+
+def _write(batch: List[Message]) -> List[Message]:
+    """Commit a batch of turns; returns the ones that were written"""
+    start = time.perf_counter()
+    for m in batch:
+        message_tokens(m)
+    db = SessionLocal()
+    try:
+        db.add_all(batch)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Write-behind batch of {len(batch)} failed, retrying one by one: {e}")
+        # One bad row should not take the rest of the batch down with it
+        written = []
+        for m in batch:
+            try:
+                db.add(m)
+                db.commit()
+                written.append(m)
+            except Exception as e:
+                db.rollback()
+                metrics.inc("writebehind_errors")
+                print(f"Dropped message for chat {m.chat_id}: {e}")
+        batch = written
+    finally:
+        db.close()
+    metrics.observe("writebehind_batch_size", len(batch))
+    metrics.observe("writebehind_write_ms", (time.perf_counter() - start) * 1000)
+    return batch
+
+def _index(batch: List[Message]):
+    start = time.perf_counter()
+    save_conversation_contexts([
+        dict(doctor_id=m.doctor_id, patient_id=m.patient_id, chat_id=m.chat_id, role=m.role,
+             text=m.text, patient_name=m.patient_name, timestamp=m.created_at)
+        for m in batch
+    ])
+    metrics.observe("writebehind_index_ms", (time.perf_counter() - start) * 1000)
@@ -16,24 +16,71 @@ export async function api(path: string, method = "GET", body?: any, token?: stri
   return res.json();
 }
 
-export function stream(path: string, body: any, token: string, onToken: (t:string)=>void) {
-  return fetch(`${BASE}${path}`, {
-    method: "POST",
-    headers: { "Content-Type": "application/json", Authorization: `Bearer ${token}` },
-    body: JSON.stringify(body)
-  }).then(async res => {
-    const reader = res.body?.getReader();
-    const decoder = new TextDecoder();
-    let done = false;
-    while (!done) {
-      const chunk = await reader!.read();
-      done = chunk.done!;
-      if (done) break;
-      const text = decoder.decode(chunk.value, { stream: true });
-      const lines = text.split("\n\n").filter(Boolean);
-      for (const line of lines) {
-        if (line.startsWith("data: ")) onToken(line.slice(6));
+// Reconnect attempts after a dropped /stream connection before giving up
+const STREAM_RESUME_ATTEMPTS = 5;
+
+export async function stream(path: string, body: any, token: string, onToken: (t:string)=>void) {
+  // "<generation>:<seq>" of the last event received; sent back as Last-Event-ID
+  // so a reconnect resumes the same generation instead of starting a new one
+  let lastId = "";
+  // Lets the server fold a retry that never got a response into the same generation
+  const idempotencyKey = crypto.randomUUID();
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const res = await fetch(`${BASE}${path}`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${token}`,
+          "Idempotency-Key": idempotencyKey,
+          ...(lastId ? { "Last-Event-ID": lastId } : {})
+        },
+        body: JSON.stringify(body)
+      });
+      if (!res.ok) throw Object.assign(new Error(await res.text()), { fatal: true });
+      const generationId = res.headers.get("X-Generation-Id");
+      if (!lastId && generationId) lastId = `${generationId}:0`;
+      if (await readEvents(res, onToken, id => { lastId = id; })) return;
+    } catch (error: any) {
+      if (error?.fatal || !lastId || attempt >= STREAM_RESUME_ATTEMPTS) throw error;
+    }
+    if (!lastId || attempt >= STREAM_RESUME_ATTEMPTS) throw new Error("Stream ended unexpectedly");
+    await new Promise(r => setTimeout(r, 500 * 2 ** attempt));
+  }
+}
+
+// Returns true once the end event arrives; false if the connection closed before it
+async function readEvents(res: Response, onToken: (t:string)=>void, onId: (id:string)=>void) {
+  const reader = res.body?.getReader();
+  const decoder = new TextDecoder();
+  // Events end with a blank line and may be split across reads, so keep the tail
+  let pending = "";
+  while (true) {
+    const chunk = await reader!.read();
+    if (chunk.done) return false;
+    pending += decoder.decode(chunk.value, { stream: true });
+    const events = pending.split("\n\n");
+    pending = events.pop() || "";
+    for (const ev of events) {
+      let name = "message";
+      let data = "";
+      let id = "";
+      for (const line of ev.split("\n")) {
+        if (line.startsWith("event: ")) name = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+        else if (line.startsWith("id: ")) id = line.slice(4);
+      }
+      if (id) onId(id);
+      if (name === "end") return true;
+      if (name === "error") throw Object.assign(new Error(data), { fatal: true });
+      // Text arrives as {"delta": "..."}; queue position events are not shown
+      if (name !== "message" || !data) continue;
+      try {
+        const delta = JSON.parse(data).delta;
+        if (delta) onToken(delta);
+      } catch {
+        onToken(data);
       }
     }
-  });
-}
\ No newline at end of file
+  }
+}